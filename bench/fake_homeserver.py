@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# A stand-in Matrix homeserver for benchmarking matrix-archive offline.
+# It serves synthetic rooms, plain or end-to-end encrypted and with media,
+# generated from a seed, so runs with the same options get the same
+# workload. Only the endpoints matrix-archive uses are implemented, plus
+#   POST /_bench/append {"events": N}  add N events to every room
+#   GET  /_bench/stats                 events and media served so far
+# The megolm keys of the encrypted rooms are exported like a client would,
+# to be imported with --keys / --keyspass.
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+
+try:
+    import olm
+except ImportError:  # matrix-nio >= 0.25 uses vodozemac and no longer installs it
+    raise SystemExit("The fake homeserver needs python-olm (and libolm): pip install -r bench/requirements.txt")
+from aiohttp import web
+from Crypto.Cipher import AES
+from nio.crypto.key_export import encrypt_and_save
+
+SERVER_NAME = "localhost"
+USER_ID = f"@bench:{SERVER_NAME}"
+DEVICE_ID = "BENCHDEVICE"
+ACCESS_TOKEN = "bench-access-token"
+MEGOLM = "m.megolm.v1.aes-sha2"
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+AVATAR_SIZE = 4096
+BASE_TS = 1600000000000
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+         "labore et dolore magna aliqua archive matrix server room message media key backup").split()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fake Matrix homeserver for matrix-archive benchmarks")
+    add_scenario_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--keys-out", dest="keys_out", metavar="FILE",
+                        help="Write the megolm keys of the encrypted rooms to FILE as a key export")
+    parser.add_argument("--keys-pass", dest="keys_pass", default="bench",
+                        help="Passphrase of the key export")
+    return parser.parse_args()
+
+
+# shared with run_bench.py, which passes them on.
+def add_scenario_arguments(parser):
+    parser.add_argument("--rooms", type=int, default=2, help="Number of rooms")
+    parser.add_argument("--encrypted-rooms", dest="encrypted_rooms", type=int, default=1,
+                        help="How many of the rooms are end-to-end encrypted")
+    parser.add_argument("--events", type=int, default=5000, help="Events per room")
+    parser.add_argument("--users", type=int, default=5, help="Members per room, each with an avatar")
+    parser.add_argument("--media-ratio", dest="media_ratio", type=float, default=0.02,
+                        help="Fraction of events that are images")
+    parser.add_argument("--media-size", dest="media_size", type=int, default=262144,
+                        help="Size of each image in bytes")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Milliseconds added to every request")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def encode_base64(data, urlsafe=False):
+    encoded = base64.urlsafe_b64encode(data) if urlsafe else base64.b64encode(data)
+    return encoded.decode().rstrip("=")
+
+
+class Homeserver():
+
+    def __init__(self, args):
+        self.args = args
+        self.block = random.Random(args.seed).getrandbits(65536 * 8).to_bytes(65536, "little")
+        # media id -> (size, encrypted)
+        self.media = {}
+        self.stats = {"events": 0, "message_requests": 0, "media_requests": 0, "media_bytes": 0}
+        self.account = olm.Account()
+        self.users = [USER_ID] + [f"@user{k}:{SERVER_NAME}" for k in range(1, args.users)]
+        for k in range(len(self.users)):
+            self.media[f"avatar{k}"] = (AVATAR_SIZE, False)
+        self.rooms = {}
+        for index in range(args.rooms):
+            room = FakeRoom(self, index, index < args.encrypted_rooms)
+            self.rooms[room.room_id] = room
+        self.append(args.events)
+
+    def append(self, count):
+        for room in self.rooms.values():
+            room.append(count)
+        self.stats["events"] += count * len(self.rooms)
+
+    # the same bytes every time they are served: a png header, the media id
+    # and the random block repeated.
+    def media_bytes(self, media_id):
+        size, encrypted = self.media[media_id]
+        header = PNG_MAGIC + media_id.encode()
+        data = (header + self.block * (size // len(self.block) + 1))[:size]
+        if encrypted:
+            key, iv = self.media_key(media_id)
+            data = AES.new(key, AES.MODE_CTR, nonce=b'', initial_value=iv).encrypt(data)
+        return data
+
+    def media_key(self, media_id):
+        digest = hashlib.sha256(f"{self.args.seed}:{media_id}".encode()).digest()
+        return digest, digest[:8] + b"\0" * 8
+
+    # content.file of an encrypted attachment
+    def media_file_info(self, media_id):
+        key, iv = self.media_key(media_id)
+        return {
+            "v": "v2",
+            "url": f"mxc://{SERVER_NAME}/{media_id}",
+            "key": {"kty": "oct", "alg": "A256CTR", "ext": True, "key_ops": ["encrypt", "decrypt"],
+                    "k": encode_base64(key, urlsafe=True)},
+            "iv": encode_base64(iv),
+            "hashes": {"sha256": encode_base64(hashlib.sha256(self.media_bytes(media_id)).digest())},
+        }
+
+    def export_keys(self, filename, passphrase):
+        sessions = [room.exported_session() for room in self.rooms.values() if room.encrypted]
+        encrypt_and_save(json.dumps(sessions).encode(), filename, passphrase)
+
+    # http handlers
+
+    async def login(self, request):
+        return web.json_response({"user_id": USER_ID, "access_token": ACCESS_TOKEN, "device_id": DEVICE_ID})
+
+    async def whoami(self, request):
+        return web.json_response({"user_id": USER_ID, "device_id": DEVICE_ID})
+
+    async def logout(self, request):
+        return web.json_response({})
+
+    async def versions(self, request):
+        return web.json_response({"versions": ["r0.6.1", "v1.1", "v1.5"]})
+
+    async def sync(self, request):
+        join = {room_id: room.sync_response() for room_id, room in self.rooms.items()}
+        return web.json_response({
+            "next_batch": f"s{self.stats['events']}",
+            "rooms": {"join": join, "invite": {}, "leave": {}},
+            "to_device": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+        })
+
+    async def messages(self, request):
+        room = self.rooms.get(request.match_info["room_id"])
+        if room is None:
+            return matrix_error(404, "M_NOT_FOUND", "Unknown room")
+        token = request.query.get("from", "")
+        if not token.startswith("t") or not token[1:].isdigit():
+            return matrix_error(400, "M_INVALID_PARAM", "Unknown token")
+        self.stats["message_requests"] += 1
+        position = min(int(token[1:]), len(room.events))
+        limit = int(request.query.get("limit", 10))
+        response = {"start": token}
+        if request.query.get("dir", "b") == "b":
+            end = max(0, position - limit)
+            response["chunk"] = room.events[end:position][::-1]
+            if end > 0:
+                response["end"] = f"t{end}"
+        else:
+            response["chunk"] = room.events[position:position + limit]
+            if response["chunk"]:
+                response["end"] = f"t{position + len(response['chunk'])}"
+        return web.json_response(response)
+
+    async def download(self, request):
+        media_id = request.match_info["media_id"]
+        if media_id not in self.media:
+            return matrix_error(404, "M_NOT_FOUND", "Unknown media")
+        data = self.media_bytes(media_id)
+        self.stats["media_requests"] += 1
+        self.stats["media_bytes"] += len(data)
+        return web.Response(body=data, content_type="application/octet-stream")
+
+    async def bench_append(self, request):
+        body = await request.json()
+        self.append(int(body.get("events", 0)))
+        return web.json_response(self.stats)
+
+    async def bench_stats(self, request):
+        return web.json_response(self.stats)
+
+    def make_app(self):
+        latency = self.args.latency / 1000
+
+        @web.middleware
+        async def add_latency(request, handler):
+            if latency > 0 and request.path.startswith("/_matrix/"):
+                await asyncio.sleep(latency)
+            return await handler(request)
+
+        app = web.Application(middlewares=[add_latency])
+        app.add_routes([
+            web.get("/_matrix/client/versions", self.versions),
+            web.post("/_matrix/client/{version}/login", self.login),
+            web.get("/_matrix/client/{version}/account/whoami", self.whoami),
+            web.post("/_matrix/client/{version}/logout", self.logout),
+            web.get("/_matrix/client/{version}/sync", self.sync),
+            web.get("/_matrix/client/{version}/rooms/{room_id}/messages", self.messages),
+            web.get("/_matrix/media/{version}/download/{server_name}/{media_id}", self.download),
+            web.get("/_matrix/media/{version}/download/{server_name}/{media_id}/{filename}", self.download),
+            web.get("/_matrix/client/v1/media/download/{server_name}/{media_id}", self.download),
+            web.post("/_bench/append", self.bench_append),
+            web.get("/_bench/stats", self.bench_stats),
+        ])
+        return app
+
+
+class FakeRoom():
+
+    def __init__(self, server, index, encrypted):
+        self.server = server
+        self.index = index
+        self.encrypted = encrypted
+        self.room_id = f"!room{index}:{SERVER_NAME}"
+        self.events = []
+        self.state_count = 0
+        self.state = [
+            self.state_event("m.room.create", "", {"creator": USER_ID}),
+            self.state_event("m.room.name", "", {"name": f"Bench room {index}"}),
+        ]
+        for k, user_id in enumerate(server.users):
+            self.state.append(self.state_event("m.room.member", user_id, {
+                "membership": "join",
+                "displayname": f"User {k}",
+                "avatar_url": f"mxc://{SERVER_NAME}/avatar{k}",
+            }))
+        if encrypted:
+            self.state.append(self.state_event("m.room.encryption", "", {"algorithm": MEGOLM}))
+            self.session = olm.OutboundGroupSession()
+            # exported before the first message, so every message decrypts
+            self.inbound_session = olm.InboundGroupSession(self.session.session_key)
+
+    def state_event(self, event_type, state_key, content):
+        self.state_count += 1
+        return {
+            "type": event_type,
+            "state_key": state_key,
+            "content": content,
+            "sender": USER_ID,
+            "event_id": f"$state{self.index}_{self.state_count}",
+            "origin_server_ts": BASE_TS,
+        }
+
+    def append(self, count):
+        for _ in range(count):
+            self.events.append(self.make_event(len(self.events)))
+
+    def make_event(self, position):
+        rnd = random.Random(f"{self.server.args.seed}:{self.index}:{position}")
+        if rnd.random() < self.server.args.media_ratio:
+            media_id = f"m{self.index}_{position}"
+            self.server.media[media_id] = (self.server.args.media_size, self.encrypted)
+            content = {
+                "msgtype": "m.image",
+                "body": f"{media_id}.png",
+                "info": {"mimetype": "image/png", "size": self.server.args.media_size},
+            }
+            if self.encrypted:
+                content["file"] = self.server.media_file_info(media_id)
+            else:
+                content["url"] = f"mxc://{SERVER_NAME}/{media_id}"
+        else:
+            content = {"msgtype": "m.text", "body": " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 30)))}
+        event = {
+            "type": "m.room.message",
+            "content": content,
+            "sender": rnd.choice(self.server.users),
+            "event_id": f"$event{self.index}_{position}",
+            "origin_server_ts": BASE_TS + position * 1000,
+            "room_id": self.room_id,
+        }
+        if self.encrypted:
+            payload = {"type": event["type"], "content": content, "room_id": self.room_id}
+            event["type"] = "m.room.encrypted"
+            event["content"] = {
+                "algorithm": MEGOLM,
+                "ciphertext": self.session.encrypt(json.dumps(payload)),
+                "sender_key": self.server.account.identity_keys["curve25519"],
+                "session_id": self.session.id,
+                "device_id": DEVICE_ID,
+            }
+        return event
+
+    def exported_session(self):
+        return {
+            "algorithm": MEGOLM,
+            "room_id": self.room_id,
+            "sender_key": self.server.account.identity_keys["curve25519"],
+            "session_id": self.session.id,
+            "session_key": self.inbound_session.export_session(0),
+            "sender_claimed_keys": {"ed25519": self.server.account.identity_keys["ed25519"]},
+            "forwarding_curve25519_key_chain": [],
+        }
+
+    def sync_response(self):
+        return {
+            "state": {"events": self.state},
+            # pagination starts after the newest event, so it fetches them all
+            "timeline": {"events": self.events[-1:], "limited": True, "prev_batch": f"t{len(self.events)}"},
+            "ephemeral": {"events": []},
+            "account_data": {"events": []},
+            "summary": {"m.joined_member_count": len(self.server.users), "m.invited_member_count": 0},
+            "unread_notifications": {"highlight_count": 0, "notification_count": 0},
+        }
+
+
+def matrix_error(status, errcode, message):
+    return web.json_response({"errcode": errcode, "error": message}, status=status)
+
+
+def main():
+    args = parse_args()
+    server = Homeserver(args)
+    if args.keys_out is not None:
+        server.export_keys(args.keys_out, args.keys_pass)
+    print(f"Serving {args.rooms} rooms with {args.events} events each on http://{args.host}:{args.port}", flush=True)
+    web.run_app(server.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Benchmark matrix-archive against fake_homeserver.py: a full run into an
+# empty folder, then an incremental run after new events were added. Reports
+# events/s, MB/s of media, peak RSS and the per-stage timings of
+# --metrics-report for each run. Arguments after -- are passed on to matrix-archive.py, e.g.
+#   python bench/run_bench.py --events 20000 --latency 20 -- --room-concurrency 2
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from fake_homeserver import USER_ID, add_scenario_arguments
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVER = os.path.join(BENCH_DIR, os.pardir, "matrix-archive.py")
+KEYS_PASS = "bench"
+SERVER_STARTUP_TIMEOUT = 300
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark matrix-archive against a fake homeserver")
+    add_scenario_arguments(parser)
+    parser.add_argument("--incremental-events", dest="incremental_events", type=int, default=None,
+                        help="Events added to every room before the incremental run (default: a tenth of --events)")
+    parser.add_argument("--workdir", help="Keep output, keys and logs here instead of a temporary folder")
+    parser.add_argument("--json", dest="json_out", metavar="FILE", help="Also write the results to FILE")
+    argv = sys.argv[1:]
+    archiver_args = []
+    if "--" in argv:
+        archiver_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+    args.archiver_args = archiver_args
+    if args.incremental_events is None:
+        args.incremental_events = max(1, args.events // 10)
+    return args
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def request(url, data=None):
+    body = None if data is None else json.dumps(data).encode()
+    with urllib.request.urlopen(urllib.request.Request(url, data=body), timeout=30) as response:
+        return json.load(response)
+
+
+def start_server(args, port, workdir):
+    scenario = ["--rooms", args.rooms, "--encrypted-rooms", args.encrypted_rooms, "--events", args.events,
+                "--users", args.users, "--media-ratio", args.media_ratio, "--media-size", args.media_size,
+                "--latency", args.latency, "--seed", args.seed]
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_homeserver.py"), "--port", str(port),
+         "--keys-out", os.path.join(workdir, "keys.txt"), "--keys-pass", KEYS_PASS] + [str(a) for a in scenario],
+        stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + SERVER_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"Fake homeserver exited, see {log.name}")
+        try:
+            request(f"http://127.0.0.1:{port}/_bench/stats")
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit("Fake homeserver didn't start in time")
+
+
+def count_events(output_dir):
+    count = 0
+    for root, dirs, files in os.walk(output_dir):
+        if "data.db" in files:
+            conn = sqlite3.connect(os.path.join(root, "data.db"))
+            try:
+                count += conn.execute("select count(*) from MESSAGE").fetchone()[0]
+            finally:
+                conn.close()
+    return count
+
+
+# one run of matrix-archive as a child process, so its peak RSS is its own.
+def run_archiver(args, name, url, workdir):
+    output_dir = os.path.join(workdir, "output")
+    report_file = os.path.join(workdir, f"metrics-{name}.json")
+    events_before = count_events(output_dir)
+    stats_before = request(f"{url}/_bench/stats")
+    with open(os.path.join(workdir, f"archiver-{name}.log"), "w") as log:
+        started = time.monotonic()
+        process = subprocess.Popen(
+            [sys.executable, ARCHIVER, output_dir, "--batch", "--server", url, "--user", USER_ID,
+             "--userpass", "bench", "--keys", os.path.join(workdir, "keys.txt"), "--keyspass", KEYS_PASS,
+             "--all-rooms", "--no-logs", "--no-progress-bar", "--metrics-report", report_file] + args.archiver_args,
+            stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - started
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    stats_after = request(f"{url}/_bench/stats")
+    events = count_events(output_dir) - events_before
+    media_mb = (stats_after["media_bytes"] - stats_before["media_bytes"]) / 1048576
+    # kilobytes on Linux, bytes on macOS
+    peak_rss_mb = usage.ru_maxrss / (1048576 if sys.platform == "darwin" else 1024)
+    report = {}
+    if os.path.exists(report_file):
+        with open(report_file) as f:
+            report = json.load(f)
+    return {
+        "run": name,
+        "exit_code": process.returncode,
+        "seconds": round(seconds, 3),
+        "events": events,
+        "events_per_second": round(events / seconds, 1),
+        "media_mb": round(media_mb, 2),
+        "mb_per_second": round(media_mb / seconds, 2),
+        "message_requests": stats_after["message_requests"] - stats_before["message_requests"],
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "stages": report.get("stages", {}),
+        "metrics": report,
+    }
+
+
+def print_results(results):
+    print(f"{'run':<12}{'exit':>5}{'seconds':>10}{'events':>9}{'events/s':>10}"
+          f"{'media MB':>10}{'MB/s':>8}{'pages':>7}{'peak RSS MB':>13}")
+    for r in results:
+        print(f"{r['run']:<12}{r['exit_code']:>5}{r['seconds']:>10.2f}{r['events']:>9}{r['events_per_second']:>10.1f}"
+              f"{r['media_mb']:>10.2f}{r['mb_per_second']:>8.2f}{r['message_requests']:>7}{r['peak_rss_mb']:>13.1f}")
+    for r in results:
+        stages = ", ".join(f"{name} {stage['seconds']:.2f}s/{stage['count']}"
+                           for name, stage in sorted(r["stages"].items(), key=lambda item: -item[1]["seconds"]))
+        print(f"{r['run']} stages (busy seconds/count): {stages or 'none'}")
+
+
+def main():
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="matrix-archive-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    print(f"Generating {args.rooms} rooms with {args.events} events each...", flush=True)
+    server = start_server(args, port, workdir)
+    try:
+        results = [run_archiver(args, "full", url, workdir)]
+        request(f"{url}/_bench/append", {"events": args.incremental_events})
+        results.append(run_archiver(args, "incremental", url, workdir))
+    finally:
+        server.terminate()
+        server.wait()
+    print_results(results)
+    if args.json_out is not None:
+        with open(args.json_out, "w") as f:
+            json.dump({"scenario": {key: value for key, value in vars(args).items() if key != "json_out"},
+                       "results": results}, f, indent=4)
+    failed = any(r["exit_code"] != 0 for r in results)
+    if args.workdir is None and not failed:
+        shutil.rmtree(workdir)
+    else:
+        print(f"Output and logs kept in {workdir}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,92 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
+import json
+import os
+import pathlib
 import sqlite3
+import struct
 import sys
+import time
+import zlib
 
+import metrics
 import utils
 
+try:
+    import zstandard
+except ImportError:  # optional, only needed for zstd compressed sources
+    zstandard = None
+
+# bound parameters per statement, SQLite allows 999 in older versions
+MAX_VARIABLES = 500
+
+# page cache of every connection, in KiB
+CACHE_SIZE = 65536
+
+# compressed SOURCE values are blobs starting with a codec byte and the id of
+# the dictionary they were compressed with (0 for none)
+SOURCE_HEADER = struct.Struct(">BI")
+SOURCE_CODECS = {"zlib": 1, "zstd": 2}
+# number of sources a compression dictionary is trained from
+DICT_SAMPLES = 1000
+DICT_SIZE = 65536
+# zlib only uses the last 32 KiB of a dictionary
+ZLIB_DICT_SIZE = 32768
+
+# PRAGMA user_version of the current schema. 0 is the schema from before
+# versioning; migrate() upgrades older databases step by step.
+SCHEMA_VERSION = 2
+
+# categories of events that couldn't be parsed or decrypted, which are
+# updated once they can
+BAD_CATEGORIES = ("BadEvent", "Unknown", "MegolmEvent")
+
+# what MESSAGE_FTS.SENDER_NAME holds for a MESSAGE row: display name and user id
+SQL_FTS_SENDER_NAME = "coalesce((select DISPLAY_NAME from SENDER where ID = {row}.SENDER_ID) || ' ', '') || coalesce({row}.SENDER, '')"
+
+SQL_INSERT_EVENT = "insert into MESSAGE (EVENT_ID, CATEGORY, DATE, BODY, SENDER, MEDIA_UUID, SOURCE, TS, SENDER_ID, ROOM_ID) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+SQL_UPDATE_EVENT = "update MESSAGE set CATEGORY = ?, DATE = ?, BODY = ?, SENDER = ?, MEDIA_UUID = ?, SOURCE = ?, TS = ?, SENDER_ID = ?, ROOM_ID = ? where EVENT_ID = ?"
+
 
 class DB:
 
-    def __init__(self, filename, roomname):
+    def __init__(self, filename, roomname, batch_size=1000, source_compression=None, room_id=None,
+                 checkpoint_interval=60):
         from utils import log
+        # seconds after which buffered events are committed even when the
+        # batch isn't full, see flush_if_due()
+        self.checkpoint_interval = checkpoint_interval
+        self.last_flush = time.monotonic()
+        self.room_id = room_id
+        # user id -> (SENDER.ID, display name)
+        self.senders = {}
+        if source_compression == "zstd" and zstandard is None:
+            raise utils.DatabaseException("Preparing table failed.", "zstd compression needs the zstandard package.")
+        self.source_compression = source_compression
+        # compression dictionaries by id, and the one new sources use
+        self.dictionaries = {}
+        self.dictionary_id = 0
+        self.samples = []
         self.sqls_insert = []
         self.sqls_update = []
+        self.checkpoints = {}
+        # called before every commit of events, e.g. to sync the export and
+        # checkpoint how far it got in the same transaction
+        self.before_commit = None
+        # event ids of the buffered inserts
+        self.pending_ids = set()
+        self.batch_size = batch_size
         self.filename = filename
         try:
             self.conn = sqlite3.connect(self.filename)
+            # WAL lets readers work during writes and only needs an fsync
+            # per checkpoint with synchronous=NORMAL, which is still safe
+            # against corruption on crashes.
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE}")
+            self.conn.execute("PRAGMA temp_store=MEMORY")
+            # columns added by later schema versions come from migrate()
             cmd_create_MESSAGE = '''
                 CREATE TABLE IF NOT EXISTS MESSAGE
                 (EVENT_ID TEXT,
@@ -31,8 +103,35 @@ class DB:
                 HASH TEXT,
                 SIZE INT);
                 '''
+            cmd_create_MEDIA_URI = '''
+                CREATE TABLE IF NOT EXISTS MEDIA_URI
+                (URI TEXT,
+                CIPHER_HASH TEXT,
+                MEDIA_UUID TEXT);
+                '''
+            cmd_create_CHECKPOINT = '''
+                CREATE TABLE IF NOT EXISTS CHECKPOINT
+                (KEY TEXT PRIMARY KEY,
+                VALUE TEXT);
+                '''
             self.conn.execute(cmd_create_MESSAGE)
             self.conn.execute(cmd_create_MEDIA)
+            self.conn.execute(cmd_create_MEDIA_URI)
+            cmd_create_SOURCE_DICT = '''
+                CREATE TABLE IF NOT EXISTS SOURCE_DICT
+                (ID INTEGER PRIMARY KEY,
+                CODEC TEXT,
+                DATA BLOB);
+                '''
+            cmd_create_CURRENT_AVATAR = '''
+                CREATE TABLE IF NOT EXISTS CURRENT_AVATAR
+                (USER_ID TEXT PRIMARY KEY,
+                URL TEXT,
+                MEDIA_NAME TEXT);
+                '''
+            self.conn.execute(cmd_create_CHECKPOINT)
+            self.conn.execute(cmd_create_SOURCE_DICT)
+            self.conn.execute(cmd_create_CURRENT_AVATAR)
             cmd_create_MESSAGE_INDEX_UNIQUE = '''
                 CREATE UNIQUE INDEX IF NOT EXISTS index_eventid ON MESSAGE (EVENT_ID);  
                 '''
@@ -44,12 +143,322 @@ class DB:
                 '''
             self.conn.execute(cmd_create_MESSAGE_INDEX_UNIQUE)
             self.conn.execute(cmd_create_MESSAGE_INDEX_DATE)
+            cmd_create_MEDIA_URI_INDEX_UNIQUE = '''
+                CREATE UNIQUE INDEX IF NOT EXISTS index_media_uri ON MEDIA_URI (URI);
+                '''
+            cmd_create_MEDIA_URI_INDEX_CIPHER_HASH = '''
+                CREATE INDEX IF NOT EXISTS index_media_cipher_hash ON MEDIA_URI (CIPHER_HASH);
+                '''
             self.conn.execute(cmd_create_MEDIA_INDEX)
+            self.conn.execute(cmd_create_MEDIA_URI_INDEX_UNIQUE)
+            self.conn.execute(cmd_create_MEDIA_URI_INDEX_CIPHER_HASH)
         except Exception as err:
             raise utils.DatabaseException("Preparing table failed.", err)
         self.c = self.conn.cursor()
+        # lets SQL read sources transparently: select DECODE_SOURCE(SOURCE) ...
+        self.conn.create_function("DECODE_SOURCE", 1, self.decode_source)
+        for dict_id, codec, data in self.conn.execute("select ID, CODEC, DATA from SOURCE_DICT"):
+            self.dictionaries[dict_id] = (codec, data)
+            if codec == self.source_compression:
+                self.dictionary_id = max(self.dictionary_id, dict_id)
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self.migrate(version, batch_size)
+        # sources stored by earlier runs count towards the dictionary, so it
+        # is trained even when no single run writes DICT_SAMPLES events
+        if source_compression is not None and self.dictionary_id == 0:
+            self.sample_stored_sources()
+            if len(self.samples) == DICT_SAMPLES:
+                self.train_dictionary()
         log(f"Database ready for room: {roomname}")
 
+    # upgrade the schema in place. every step can be repeated and the row
+    # backfill commits batch by batch, so an interrupted migration simply
+    # continues on the next start.
+    def migrate(self, version, batch_size=1000):
+        try:
+            # progress of both row steps used to be kept under this key, so
+            # which one it belongs to is unknown, they just start over
+            with self.conn:
+                self.c.execute("delete from CHECKPOINT where KEY = ?", ("migration_rowid",))
+            if version < 1:
+                # integer timestamps, normalised senders and the room id
+                columns = [row[1] for row in self.conn.execute("PRAGMA table_info(MESSAGE)")]
+                for column, column_type in (("TS", "INTEGER"), ("SENDER_ID", "INTEGER"), ("ROOM_ID", "TEXT")):
+                    if column not in columns:
+                        self.conn.execute(f"ALTER TABLE MESSAGE ADD COLUMN {column} {column_type}")
+                self.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS SENDER
+                    (ID INTEGER PRIMARY KEY,
+                    USER_ID TEXT UNIQUE,
+                    DISPLAY_NAME TEXT);
+                    ''')
+                self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS index_room_ts ON MESSAGE (ROOM_ID, TS, EVENT_ID)")
+                self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS index_sender_ts ON MESSAGE (SENDER_ID, TS, EVENT_ID)")
+                # sizes used to be written as strings
+                self.conn.execute("UPDATE MEDIA SET SIZE = CAST(SIZE AS INTEGER) WHERE typeof(SIZE) = 'text'")
+                self.conn.commit()
+                self.backfill_typed_columns(batch_size)
+                self.conn.execute("PRAGMA user_version = 1")
+            if version < 2:
+                # full-text index over body, sender and category. without
+                # FTS5 the database stays at version 1 and only this step is
+                # tried again.
+                if not self.create_fts(batch_size):
+                    return
+                self.conn.execute("PRAGMA user_version = 2")
+        except utils.DatabaseException:
+            raise
+        except Exception as err:
+            raise utils.DatabaseException("Migrating database failed.", err)
+
+    # fill TS, SENDER_ID and ROOM_ID of rows written before schema 1 from
+    # their stored source.
+    def backfill_typed_columns(self, batch_size):
+        last_rowid = int(self.get_checkpoint("migration_typed_rowid") or 0)
+        while True:
+            rows = self.c.execute(
+                "select rowid, SENDER, SOURCE from MESSAGE where rowid > ? order by rowid limit ?",
+                (last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for rowid, sender, value in rows:
+                try:
+                    source = json.loads(self.decode_source(value) or "{}")
+                except ValueError:
+                    source = {}
+                ts = source.get("origin_server_ts")
+                # _sender_name is "display name <@user:server>" for members
+                display_name = None
+                sender_name = str(source.get("_sender_name", ""))
+                if sender and sender_name.endswith(f" <{sender}>"):
+                    display_name = sender_name[:-len(f" <{sender}>")]
+                updates.append((ts if isinstance(ts, int) else None,
+                                self.get_sender_id(sender, display_name),
+                                self.room_id or source.get("room_id"),
+                                rowid))
+            last_rowid = rows[-1][0]
+            with self.conn:
+                self.c.executemany(
+                    "update MESSAGE set TS = ?, SENDER_ID = ?, ROOM_ID = coalesce(ROOM_ID, ?) where rowid = ?",
+                    updates)
+                self.c.execute(
+                    "insert or replace into CHECKPOINT (KEY, VALUE) values (?, ?)",
+                    ("migration_typed_rowid", str(last_rowid)))
+            utils.log(f"Migrated events up to row {last_rowid}.")
+        with self.conn:
+            self.c.execute("delete from CHECKPOINT where KEY = ?", ("migration_typed_rowid",))
+
+    # MESSAGE_FTS indexes every MESSAGE row under the same rowid. existing
+    # rows are indexed in batches, triggers keep it up to date afterwards,
+    # so every flushed batch of events is searchable right away.
+    # returns False if this SQLite has no FTS5.
+    def create_fts(self, batch_size):
+        try:
+            self.conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS MESSAGE_FTS
+                USING fts5(BODY, SENDER_NAME, CATEGORY, tokenize = 'unicode61 remove_diacritics 2');
+                ''')
+        except sqlite3.OperationalError as err:
+            utils.log(f"Full-text search is not available: {err}", file=sys.stderr)
+            return False
+        last_rowid = int(self.get_checkpoint("migration_fts_rowid") or 0)
+        while True:
+            row = self.c.execute(
+                "select max(rowid) from (select rowid from MESSAGE where rowid > ? order by rowid limit ?)",
+                (last_rowid, batch_size)).fetchone()
+            if row[0] is None:
+                break
+            with self.conn:
+                self.c.execute(
+                    "insert or replace into MESSAGE_FTS (rowid, BODY, SENDER_NAME, CATEGORY) "
+                    f"select rowid, BODY, {SQL_FTS_SENDER_NAME.format(row='MESSAGE')}, CATEGORY from MESSAGE "
+                    "where rowid > ? and rowid <= ?",
+                    (last_rowid, row[0]))
+                self.c.execute(
+                    "insert or replace into CHECKPOINT (KEY, VALUE) values (?, ?)",
+                    ("migration_fts_rowid", str(row[0])))
+            last_rowid = row[0]
+            utils.log(f"Indexed events up to row {last_rowid} for search.")
+        with self.conn:
+            self.c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON MESSAGE BEGIN
+                    INSERT OR REPLACE INTO MESSAGE_FTS (rowid, BODY, SENDER_NAME, CATEGORY)
+                    VALUES (new.rowid, new.BODY, {SQL_FTS_SENDER_NAME.format(row='new')}, new.CATEGORY);
+                END;
+                ''')
+            self.c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF BODY, SENDER, SENDER_ID, CATEGORY ON MESSAGE BEGIN
+                    INSERT OR REPLACE INTO MESSAGE_FTS (rowid, BODY, SENDER_NAME, CATEGORY)
+                    VALUES (new.rowid, new.BODY, {SQL_FTS_SENDER_NAME.format(row='new')}, new.CATEGORY);
+                END;
+                ''')
+            self.c.execute('''
+                CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON MESSAGE BEGIN
+                    DELETE FROM MESSAGE_FTS WHERE rowid = old.rowid;
+                END;
+                ''')
+            self.c.execute("delete from CHECKPOINT where KEY = ?", ("migration_fts_rowid",))
+        return True
+
+    # full-text search, best matches first. query uses the FTS5 syntax,
+    # e.g. 'hello world', '"exact phrase"' or 'SENDER_NAME: alice'.
+    def search(self, query, limit=20, offset=0):
+        return search_messages(self.c, query, limit, offset)
+
+    # id of a user in the SENDER table, added on first sight. the display
+    # name is kept up to date when one is known.
+    def get_sender_id(self, user_id, display_name=None):
+        if not user_id:
+            return None
+        cached = self.senders.get(user_id)
+        try:
+            if cached is None:
+                cached = self.c.execute(
+                    "select ID, DISPLAY_NAME from SENDER where USER_ID = ?", (user_id,)).fetchone()
+                if cached is None:
+                    cursor = self.c.execute(
+                        "insert into SENDER (USER_ID, DISPLAY_NAME) values (?, ?)", (user_id, display_name))
+                    cached = (cursor.lastrowid, display_name)
+                self.senders[user_id] = cached
+            if display_name is not None and display_name != cached[1]:
+                self.c.execute("update SENDER set DISPLAY_NAME = ? where ID = ?", (display_name, cached[0]))
+                cached = (cached[0], display_name)
+                self.senders[user_id] = cached
+        except Exception as err:
+            raise utils.DatabaseException("Update sender in database failed.", err)
+        return cached[0]
+
+    # SOURCE is stored as minified JSON text, or as a compressed blob with
+    # --source-compression. decode_source turns either back into JSON text.
+    def encode_source(self, source):
+        if self.source_compression is None or not source:
+            return source
+        if self.dictionary_id == 0 and len(self.samples) < DICT_SAMPLES:
+            self.samples.append(source.encode('utf-8'))
+            if len(self.samples) == DICT_SAMPLES:
+                self.train_dictionary()
+        data = source.encode('utf-8')
+        zdict = None
+        if self.dictionary_id != 0:
+            zdict = self.dictionaries[self.dictionary_id][1]
+        if self.source_compression == "zstd":
+            if zdict is None:
+                compressor = zstandard.ZstdCompressor(level=3)
+            else:
+                compressor = zstandard.ZstdCompressor(level=3, dict_data=zstandard.ZstdCompressionDict(zdict))
+            payload = compressor.compress(data)
+        else:
+            if zdict is None:
+                compressor = zlib.compressobj(6)
+            else:
+                compressor = zlib.compressobj(6, zdict=zdict)
+            payload = compressor.compress(data) + compressor.flush()
+        return SOURCE_HEADER.pack(SOURCE_CODECS[self.source_compression], self.dictionary_id) + payload
+
+    def decode_source(self, value):
+        if not isinstance(value, bytes):
+            return value
+        codec, dict_id = SOURCE_HEADER.unpack_from(value)
+        payload = value[SOURCE_HEADER.size:]
+        zdict = None
+        if dict_id != 0:
+            zdict = self.dictionaries[dict_id][1]
+        if codec == SOURCE_CODECS["zstd"]:
+            if zstandard is None:
+                raise utils.DatabaseException("Reading source failed.", "zstd compression needs the zstandard package.")
+            if zdict is None:
+                decompressor = zstandard.ZstdDecompressor()
+            else:
+                decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(zdict))
+            return decompressor.decompress(payload).decode('utf-8')
+        if zdict is None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = zlib.decompressobj(zdict=zdict)
+        return (decompressor.decompress(payload) + decompressor.flush()).decode('utf-8')
+
+    # a dictionary trained on the sources of this room shares the keys and
+    # structure every event repeats, which is most of a small event.
+    def train_dictionary(self):
+        if self.source_compression == "zstd":
+            try:
+                data = zstandard.train_dictionary(DICT_SIZE, self.samples).as_bytes()
+            except zstandard.ZstdError:
+                # too few or too uniform samples, go on without dictionary
+                self.samples.clear()
+                return
+        else:
+            # zlib has no training, the most recent samples serve as dictionary
+            data = b''.join(self.samples)[-ZLIB_DICT_SIZE:]
+        try:
+            cursor = self.c.execute(
+                "insert into SOURCE_DICT (CODEC, DATA) values (?, ?)", (self.source_compression, data))
+        except Exception as err:
+            raise utils.DatabaseException("Insert compression dictionary into database failed.", err)
+        self.dictionaries[cursor.lastrowid] = (self.source_compression, data)
+        self.dictionary_id = cursor.lastrowid
+        self.samples.clear()
+
+    # samples for train_dictionary from the sources already in the database
+    def sample_stored_sources(self):
+        try:
+            rows = self.c.execute("select SOURCE from MESSAGE limit ?", (DICT_SAMPLES,)).fetchall()
+        except Exception as err:
+            raise utils.DatabaseException("Select events from database failed.", err)
+        for (value,) in rows:
+            source = self.decode_source(value)
+            if source:
+                self.samples.append(minify_source(source).encode('utf-8'))
+
+    def get_event_source(self, event_id):
+        try:
+            row = self.c.execute(
+                "select SOURCE from MESSAGE where EVENT_ID = ?", (event_id,)).fetchone()
+        except Exception as err:
+            raise utils.DatabaseException("Select event from database failed.", err)
+        if row is None:
+            return None
+        return self.decode_source(row[0])
+
+    # re-encode every stored source with the current settings, batch by batch,
+    # then give the space back to the file system.
+    def compact_sources(self, batch_size=1000):
+        if self.source_compression is not None and self.dictionary_id == 0:
+            if not self.samples:
+                self.sample_stored_sources()
+            if self.samples:
+                self.train_dictionary()
+        last_rowid = 0
+        while True:
+            try:
+                rows = self.c.execute(
+                    "select rowid, SOURCE from MESSAGE where rowid > ? order by rowid limit ?",
+                    (last_rowid, batch_size)).fetchall()
+            except Exception as err:
+                raise utils.DatabaseException("Select events from database failed.", err)
+            if not rows:
+                break
+            updates = []
+            for rowid, value in rows:
+                source = self.decode_source(value)
+                if source:
+                    source = minify_source(source)
+                updates.append((self.encode_source(source), rowid))
+            try:
+                with self.conn:
+                    self.c.executemany("update MESSAGE set SOURCE = ? where rowid = ?", updates)
+            except Exception as err:
+                raise utils.DatabaseException("Update existing events in database failed.", err)
+            last_rowid = rows[-1][0]
+        try:
+            self.conn.execute("VACUUM")
+        except Exception as err:
+            raise utils.DatabaseException("Vacuum database failed.", err)
+
     def get_media_with_hash(self, hash):
         try:
             cursor = self.c.execute(
@@ -65,89 +474,345 @@ class DB:
             results.append(rowdict)
         return results
 
+    # the avatar saved in currentavatars/ for each member, as
+    # user id -> (mxc url, media file).
+    def get_current_avatars(self):
+        try:
+            rows = self.c.execute("select USER_ID, URL, MEDIA_NAME from CURRENT_AVATAR").fetchall()
+        except Exception as err:
+            raise utils.DatabaseException("Select current avatars from database failed.", err)
+        return {user_id: (url, media_name) for user_id, url, media_name in rows}
+
+    # avatars is a list of (user id, mxc url, media file), removed the user
+    # ids whose avatar is gone.
+    def set_current_avatars(self, avatars, removed=()):
+        try:
+            with self.conn:
+                self.c.executemany(
+                    "insert or replace into CURRENT_AVATAR (USER_ID, URL, MEDIA_NAME) values (?, ?, ?)", avatars)
+                self.c.executemany("delete from CURRENT_AVATAR where USER_ID = ?", [(user_id,) for user_id in removed])
+        except Exception as err:
+            raise utils.DatabaseException("Update current avatars in database failed.", err)
+
+    # pagination state of the room, e.g. newest/oldest tokens seen so far.
+    def get_checkpoint(self, key):
+        try:
+            cursor = self.c.execute(
+                "select VALUE from CHECKPOINT where KEY = ?", (key,))
+        except Exception as err:
+            raise utils.DatabaseException("Select checkpoint from database failed.", err)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    # buffered like events: the value is written in the same transaction as
+    # the events passed in before it, so a checkpoint never points past
+    # events that are not in the database yet.
+    def set_checkpoint(self, key, value):
+        self.checkpoints[key] = value
+
+    # media rows are committed together with the next batch of events.
     def insert_media(self, uuid, hash, size):
-        args = (uuid, hash, str(size))
+        args = (uuid, hash, size)
         try:
             self.c.execute(
                 "insert into MEDIA (uuid, hash, size) values (?, ?, ?)", args)
-            self.conn.commit()
         except Exception as err:
             raise utils.DatabaseException("Insert media item into database failed.", err)
             sys.exit(3)
 
-    def insert_event(self, id, category, date, body, sender, media_uuid, source):
-        args = (id, category, date, body, sender, media_uuid, source)
+    # stored BadEvent/Unknown/undecrypted rows after rowid, as
+    # (rowid, event id, decoded source).
+    def get_bad_events(self, after_rowid=0, limit=100):
+        condition = " or ".join("CATEGORY like ?" for _ in BAD_CATEGORIES)
+        try:
+            rows = self.c.execute(
+                f"select rowid, EVENT_ID, SOURCE from MESSAGE where ({condition}) and rowid > ? order by rowid limit ?",
+                tuple(f"%{bad}%" for bad in BAD_CATEGORIES) + (after_rowid, limit)).fetchall()
+        except Exception as err:
+            raise utils.DatabaseException("Select events from database failed.", err)
+        return [(rowid, event_id, self.decode_source(value)) for rowid, event_id, value in rows]
 
-        self.sqls_insert.append(args)
-        if len(self.sqls_insert) >= 100:
-            try:
-                for arg in self.sqls_insert:
-                    self.c.execute(
-                        "insert into MESSAGE (EVENT_ID, CATEGORY, DATE, BODY, SENDER, MEDIA_UUID, SOURCE) values (?, ?, ?, ?, ?, ?, ?)",
-                        arg)
-                self.sqls_insert.clear()
-                self.conn.commit()
-            except Exception as err:
-                raise utils.DatabaseException("Insert events into database failed.", err)
-                sys.exit(3)
+    def get_media_uuids(self):
+        try:
+            return set(row[0] for row in self.c.execute("select UUID from MEDIA"))
+        except Exception as err:
+            raise utils.DatabaseException("Select from database failed.", err)
 
-    def update_event(self, id, category, date, body, sender, media_uuid, source):
-        args = (category, date, body, sender, media_uuid, source, id)
+    # look up the stored file an mxc uri (or, for encrypted files, the
+    # sha256 of the ciphertext) was saved as, None if it is unknown.
+    def get_media_with_uri(self, uri, cipher_hash=None):
+        try:
+            row = self.c.execute(
+                "select MEDIA_UUID from MEDIA_URI where URI = ?", (uri,)).fetchone()
+            if row is None and cipher_hash is not None:
+                row = self.c.execute(
+                    "select MEDIA_UUID from MEDIA_URI where CIPHER_HASH = ?", (cipher_hash,)).fetchone()
+        except Exception as err:
+            raise utils.DatabaseException("Select from database failed.", err)
+        if row is None:
+            return None
+        return row[0]
 
-        self.sqls_update.append(args)
+    def insert_media_uri(self, uri, cipher_hash, media_uuid):
+        args = (uri, cipher_hash, media_uuid)
         try:
-            if len(self.sqls_update) >= 100:
-                for arg in self.sqls_update:
-                    self.c.execute(
-                        "update MESSAGE set CATEGORY = ?, DATE = ?, BODY = ?, SENDER = ?, MEDIA_UUID = ?, SOURCE = ? where EVENT_ID = ?",
-                        arg)
-                self.sqls_update.clear()
-                self.conn.commit()
+            self.c.execute(
+                "insert or replace into MEDIA_URI (URI, CIPHER_HASH, MEDIA_UUID) values (?, ?, ?)", args)
         except Exception as err:
-            raise utils.DatabaseException("Update existing events in database failed.", err)
-            sys.exit(3)
+            raise utils.DatabaseException("Insert media uri into database failed.", err)
 
-    def flush_events(self):
+    # (uri, cipher hash, media file) of every saved mxc uri
+    def get_media_uris(self):
         try:
-            for arg_insert in self.sqls_insert:
-                self.c.execute(
-                    "insert into MESSAGE (EVENT_ID, CATEGORY, DATE, BODY, SENDER, MEDIA_UUID, SOURCE) values (?, ?, ?, ?, ?, ?, ?)",
-                    arg_insert)
-            self.sqls_insert.clear()
-            self.conn.commit()
+            return self.c.execute("select URI, CIPHER_HASH, MEDIA_UUID from MEDIA_URI").fetchall()
         except Exception as err:
-            raise utils.DatabaseException("Finishing insert list failed.", err)
-            sys.exit(3)
+            raise utils.DatabaseException("Select from database failed.", err)
+
+    # point events, uris, media and current avatar rows at new names of media
+    # files, e.g. after they were moved into the media store. _file_path in
+    # the stored sources is rewritten as well. events of de-duplicated downloads refer
+    # to a file by its uuid only, without the extension.
+    def rename_media(self, names):
+        names = dict(names)
+        names.update({old.split('.')[0]: new for old, new in list(names.items())})
         try:
-            for arg_update in self.sqls_update:
-                self.c.execute(
-                    "update MESSAGE set CATEGORY = ?, DATE = ?, BODY = ?, SENDER = ?, MEDIA_UUID = ?, SOURCE = ? where EVENT_ID = ?",
-                    arg_update)
-            self.sqls_update.clear()
-            self.conn.commit()
+            with self.conn:
+                rows = self.c.execute(
+                    "select rowid, MEDIA_UUID, SOURCE from MESSAGE where MEDIA_UUID is not null and MEDIA_UUID != ''"
+                ).fetchall()
+                updates = []
+                for rowid, old, value in rows:
+                    if old not in names:
+                        continue
+                    source = json.loads(self.decode_source(value))
+                    source["_file_path"] = names[old]
+                    updates.append((names[old], self.encode_source(minify_source(json.dumps(source))), rowid))
+                self.c.executemany("update MESSAGE set MEDIA_UUID = ?, SOURCE = ? where rowid = ?", updates)
+                self.c.executemany("update MEDIA_URI set MEDIA_UUID = ? where MEDIA_UUID = ?",
+                                   [(new, old) for old, new in names.items()])
+                self.c.executemany("update MEDIA set UUID = ? where UUID = ?",
+                                   [(new, old) for old, new in names.items()])
+                self.c.executemany("update CURRENT_AVATAR set MEDIA_NAME = ? where MEDIA_NAME = ?",
+                                   [(new, old) for old, new in names.items()])
         except Exception as err:
-            raise utils.DatabaseException("Finishing update list failed.", err)
-            sys.exit(3)
+            raise utils.DatabaseException("Rename media in database failed.", err)
+
+    def insert_event(self, id, category, date, body, sender, media_uuid, source, ts=None, sender_name=None):
+        args = (id, category, date, body, sender, media_uuid, self.encode_source(source),
+                ts, self.get_sender_id(sender, sender_name), self.room_id)
+
+        self.sqls_insert.append(args)
+        self.pending_ids.add(id)
+        if len(self.sqls_insert) >= self.batch_size:
+            self.flush_events()
+
+    def update_event(self, id, category, date, body, sender, media_uuid, source, ts=None, sender_name=None):
+        args = (category, date, body, sender, media_uuid, self.encode_source(source),
+                ts, self.get_sender_id(sender, sender_name), self.room_id, id)
+
+        self.sqls_update.append(args)
+        if len(self.sqls_update) >= self.batch_size:
+            self.flush_events()
+
+    # write all buffered events and checkpoints in one transaction.
+    def flush_events(self):
+        if self.sqls_insert or self.sqls_update:
+            metrics.DB_FLUSH_ROWS.observe(len(self.sqls_insert) + len(self.sqls_update))
+        with metrics.stage("db_write"):
+            self.write_events()
+
+    def write_events(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        try:
+            with self.conn:
+                if self.sqls_insert:
+                    self.c.executemany(SQL_INSERT_EVENT, self.sqls_insert)
+                if self.sqls_update:
+                    self.c.executemany(SQL_UPDATE_EVENT, self.sqls_update)
+                if self.checkpoints:
+                    self.c.executemany(
+                        "insert or replace into CHECKPOINT (KEY, VALUE) values (?, ?)",
+                        list(self.checkpoints.items()))
+        except Exception as err:
+            raise utils.DatabaseException("Writing events into database failed.", err)
+        self.sqls_insert.clear()
+        self.sqls_update.clear()
+        self.checkpoints.clear()
+        self.pending_ids.clear()
+        self.last_flush = time.monotonic()
+
+    # commit what is buffered if the last commit is older than
+    # checkpoint_interval, so a killed run loses at most that much work.
+    def flush_if_due(self):
+        if time.monotonic() - self.last_flush >= self.checkpoint_interval:
+            self.flush_events()
 
     def event_exists(self, event):
+        return self.classify_events([event])[0]
+
+    # decide for a whole page of events with one query what to do with each:
+    # "insert" if it is new, "update" if it is stored as a BadEvent/Unknown
+    # but parses now, "nodo" otherwise.
+    def classify_events(self, events):
+        event_ids = [event.event_id for event in events]
+        stored = {}
         try:
-            cursor = self.c.execute(
-                "select EVENT_ID, CATEGORY from MESSAGE where EVENT_ID = ?", (event.event_id,))
+            for i in range(0, len(event_ids), MAX_VARIABLES):
+                chunk = event_ids[i:i + MAX_VARIABLES]
+                cursor = self.c.execute(
+                    f"select EVENT_ID, CATEGORY from MESSAGE where EVENT_ID in ({','.join('?' * len(chunk))})",
+                    chunk)
+                stored.update(cursor.fetchall())
         except Exception as err:
-            raise utils.DatabaseException("Select event from database failed.", err)
-            sys.exit(3)
+            raise utils.DatabaseException("Select events from database failed.", err)
+        # buffered inserts are not in the table yet
+        seen = set(self.pending_ids)
         results = []
-        for row in cursor:
-            rowdict = dict()
-            rowdict['id'] = row[0]
-            rowdict['category'] = row[1]
-            results.append(rowdict)
-        for result in results:
-            if ("BadEvent" in str(result['category']) or ("Unknown" in str(result['category']))):
-                if ("BadEvent" in str(type(event))) or ("Unknown" in str(type(event))):
-                    return "nodo"
+        for event in events:
+            if event.event_id in seen:
+                results.append("nodo")
+            elif event.event_id in stored:
+                if is_bad_category(stored[event.event_id]) and not is_bad_category(type(event).__name__):
+                    results.append("update")
                 else:
-                    return "update"
+                    results.append("nodo")
             else:
-                return "nodo"
-        return "insert"
+                seen.add(event.event_id)
+                results.append("insert")
+        return results
+
+
+# the index of the media store shared by all rooms (--media-store): which
+# file holds content with a hash and size, and which file an mxc uri was
+# saved as. rows are committed right away, other rooms may look them up.
+class MediaIndex:
+
+    def __init__(self, filename):
+        try:
+            self.conn = sqlite3.connect(filename)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            with self.conn:
+                self.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS MEDIA
+                    (NAME TEXT PRIMARY KEY NOT NULL,
+                    HASH TEXT NOT NULL,
+                    SIZE INTEGER NOT NULL);''')
+                self.conn.execute("CREATE INDEX IF NOT EXISTS index_media ON MEDIA (HASH)")
+                self.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS MEDIA_URI
+                    (URI TEXT PRIMARY KEY NOT NULL,
+                    CIPHER_HASH TEXT,
+                    NAME TEXT NOT NULL);''')
+                self.conn.execute("CREATE INDEX IF NOT EXISTS index_media_cipher_hash ON MEDIA_URI (CIPHER_HASH)")
+        except Exception as err:
+            raise utils.DatabaseException("Open media index failed.", err)
+
+    # same format as DB.get_media_with_hash
+    def get_media_with_hash(self, hash):
+        try:
+            rows = self.conn.execute("select NAME, SIZE from MEDIA where HASH = ?", (hash,)).fetchall()
+        except Exception as err:
+            raise utils.DatabaseException("Select from media index failed.", err)
+        return [{'uuid': name, 'size': size} for name, size in rows]
+
+    def insert_media(self, name, hash, size):
+        try:
+            with self.conn:
+                self.conn.execute("insert or replace into MEDIA (NAME, HASH, SIZE) values (?, ?, ?)",
+                                  (name, hash, size))
+        except Exception as err:
+            raise utils.DatabaseException("Insert into media index failed.", err)
+
+    def get_media_with_uri(self, uri, cipher_hash=None):
+        try:
+            row = self.conn.execute("select NAME from MEDIA_URI where URI = ?", (uri,)).fetchone()
+            if row is None and cipher_hash is not None:
+                row = self.conn.execute(
+                    "select NAME from MEDIA_URI where CIPHER_HASH = ?", (cipher_hash,)).fetchone()
+        except Exception as err:
+            raise utils.DatabaseException("Select from media index failed.", err)
+        return None if row is None else row[0]
+
+    def insert_media_uri(self, uri, cipher_hash, name):
+        try:
+            with self.conn:
+                self.conn.execute("insert or replace into MEDIA_URI (URI, CIPHER_HASH, NAME) values (?, ?, ?)",
+                                  (uri, cipher_hash, name))
+        except Exception as err:
+            raise utils.DatabaseException("Insert into media index failed.", err)
+
+    def close(self):
+        self.conn.close()
+
+
+def minify_source(source):
+    return json.dumps(json.loads(source), ensure_ascii=False, separators=(',', ':'))
+
+
+# checkpoints of a room database without opening it as DB, empty if the room
+# was never archived.
+def read_checkpoints(filename):
+    if not os.path.exists(filename):
+        return {}
+    try:
+        conn = sqlite3.connect(filename)
+        try:
+            return dict(conn.execute("select KEY, VALUE from CHECKPOINT").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.OperationalError:
+        # database from before checkpoints were introduced
+        return {}
+
+
+# full-text search in MESSAGE_FTS, results ordered by rank.
+def search_messages(c, query, limit=20, offset=0):
+    try:
+        cursor = c.execute(
+            "select m.EVENT_ID, m.TS, m.DATE, m.SENDER, s.DISPLAY_NAME, m.BODY, m.CATEGORY, m.MEDIA_UUID, "
+            "f.rank, snippet(MESSAGE_FTS, 0, '[', ']', '...', 16) "
+            "from MESSAGE_FTS f join MESSAGE m on m.rowid = f.rowid "
+            "left join SENDER s on s.ID = m.SENDER_ID "
+            "where MESSAGE_FTS match ? order by f.rank limit ? offset ?",
+            (query, limit, offset))
+    except Exception as err:
+        raise utils.DatabaseException("Search in database failed.", err)
+    results = []
+    for row in cursor:
+        rowdict = dict()
+        rowdict['event_id'] = row[0]
+        rowdict['ts'] = row[1]
+        rowdict['date'] = row[2]
+        rowdict['sender'] = row[3]
+        rowdict['sender_name'] = row[4]
+        rowdict['body'] = row[5]
+        rowdict['category'] = row[6]
+        rowdict['media_uuid'] = row[7]
+        rowdict['rank'] = row[8]
+        rowdict['snippet'] = row[9]
+        results.append(rowdict)
+    return results
+
+
+# search a room database without opening it as a DB, which would upgrade it.
+# None if it has no MESSAGE_FTS yet, i.e. it wasn't archived since full-text
+# search was introduced.
+def search_database(filename, query, limit=20, offset=0):
+    try:
+        conn = sqlite3.connect(f"{pathlib.Path(os.path.abspath(filename)).as_uri()}?mode=ro", uri=True)
+        try:
+            if conn.execute("select 1 from sqlite_master where name = 'MESSAGE_FTS'").fetchone() is None:
+                return None
+            return search_messages(conn.cursor(), query, limit, offset)
+        finally:
+            conn.close()
+    except sqlite3.Error as err:
+        raise utils.DatabaseException(f"Search in {filename} failed.", err)
+
+
+def is_bad_category(category):
+    return any(bad in str(category) for bad in BAD_CATEGORIES)
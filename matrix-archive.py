@@ -3,17 +3,23 @@
 
 import argparse
 import asyncio
+import contextlib
 import datetime
 import getpass
+import glob
 import itertools
 import json
+import logging
 import os
 import re
+import shutil
+import signal
 import sys
-from functools import partial
+import time
+
 from urllib.parse import urlparse
+import aiohttp
 
-import aiofiles
 from nio import (
     Api,
     AsyncClient,
@@ -26,30 +32,65 @@ from nio import (
     RoomAvatarEvent,
     RoomMessageMedia,
     Event,
-    crypto,
+    MegolmEvent,
     store,
     exceptions
 )
 from nio.responses import (
-	RoomMessagesError
+	ErrorResponse,
+	LoginResponse,
+	RoomMessagesError,
+	SyncError,
+	WhoamiResponse
 )
 
+import metrics
 import utils
 from db import (
-    DB
+    DB,
+    read_checkpoints,
+    search_database
 )
 from utils import (
     put_media,
-    generate_uuid1,
-    download_url,
+    find_media,
+    attachment_cipher,
+    part_filename,
+    Downloader,
     mkdir,
     log,
     ShowProcess,
+    reconcile_media,
+    MediaStore,
+    truncate_partial_line,
+    JsonArrayWriter,
+    finish_json_export,
+    NdjsonWriter,
+    Progress,
+    setup_logging,
+    MediaWorkers,
+    RequestGovernor,
+    RetryableError,
+    DownloadError,
+    open_text,
     NetworkException,
     DatabaseException
 )
 
 DEVICE_NAME = "matrix-archive"
+# --follow: long-poll timeout of sync in ms, events per room per sync, and
+# seconds to wait after a failed sync
+FOLLOW_SYNC_TIMEOUT = 30000
+FOLLOW_TIMELINE_LIMIT = 100
+FOLLOW_RETRY_DELAY = 10
+# --redecrypt: stored events retried at once
+REDECRYPT_BATCH_SIZE = 100
+# --media-store: folder in OUTPUT_DIR that holds the media of all rooms
+MEDIA_STORE_DIR = "media-store"
+# the MediaStore when --media-store is set
+STORE = None
+# RoomEventFilter sent with every page, None without filter options
+EVENT_FILTER = None
 
 
 def parse_args():
@@ -114,6 +155,14 @@ def parse_args():
         help="""Set default passphrase for room E2E keys
              """,
     )
+    parser.add_argument(
+        "--store-dir",
+        dest="store_dir",
+        metavar="DIRECTORY",
+        help="""Keep the login, device and E2E keys in this directory and reuse
+             them on the next run instead of logging in as a new device
+             """,
+    )
     parser.add_argument(
         "--room",
         metavar="ROOM_ID",
@@ -142,6 +191,261 @@ def parse_args():
         help="""Don't download media
              """,
     )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="""After archiving the selected rooms, keep running and archive
+             new events as they arrive
+             """,
+    )
+    parser.add_argument(
+        "--redecrypt",
+        action="store_true",
+        help="""Only retry decrypting the stored BadEvent/Unknown/undecrypted
+             events of the selected rooms with the current keys, then exit
+             """,
+    )
+    parser.add_argument(
+        "--full-scan",
+        dest="full_scan",
+        action="store_true",
+        help="""Ignore saved checkpoints and paginate the whole room history again
+             """,
+    )
+    parser.add_argument(
+        "--room-concurrency",
+        dest="room_concurrency",
+        metavar="N",
+        type=int,
+        default=1,
+        help="""Number of rooms archived at the same time
+             """,
+    )
+    parser.add_argument(
+        "--media-concurrency",
+        dest="media_concurrency",
+        metavar="N",
+        type=int,
+        default=8,
+        help="""Number of media files downloaded in parallel from each host
+             """,
+    )
+    parser.add_argument(
+        "--max-requests",
+        dest="max_requests",
+        metavar="N",
+        type=int,
+        default=16,
+        help="""Upper limit of concurrent requests to the homeserver, the
+             actual number adapts to its latency and errors
+             """,
+    )
+    parser.add_argument(
+        "--media-workers",
+        dest="media_workers",
+        metavar="N",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="""Number of workers decrypting and hashing downloaded media off
+             the event loop, 0 to do it inline (default: number of CPUs)
+             """,
+    )
+    parser.add_argument(
+        "--media-pool",
+        dest="media_pool",
+        choices=["thread", "process"],
+        default="thread",
+        help="""Run media workers as threads (default) or as processes
+             """,
+    )
+    parser.add_argument(
+        "--page-size",
+        dest="page_size",
+        metavar="EVENTS",
+        type=int,
+        default=100,
+        help="""Number of events requested per page of room messages
+             (default: 100)
+             """,
+    )
+    parser.add_argument(
+        "--include-types",
+        dest="include_types",
+        metavar="TYPE",
+        nargs="+",
+        help="""Only archive events of these types, e.g. m.room.message
+             m.room.encrypted. A trailing * matches any suffix
+             """,
+    )
+    parser.add_argument(
+        "--exclude-types",
+        dest="exclude_types",
+        metavar="TYPE",
+        nargs="+",
+        help="""Don't archive events of these types, e.g. m.reaction
+             """,
+    )
+    parser.add_argument(
+        "--include-senders",
+        dest="include_senders",
+        metavar="USER_ID",
+        nargs="+",
+        help="""Only archive events sent by these users
+             """,
+    )
+    parser.add_argument(
+        "--exclude-senders",
+        dest="exclude_senders",
+        metavar="USER_ID",
+        nargs="+",
+        help="""Don't archive events sent by these users
+             """,
+    )
+    parser.add_argument(
+        "--lazy-load-members",
+        dest="lazy_load_members",
+        action="store_true",
+        help="""Ask the homeserver to send only the member events needed for
+             each page instead of all of them
+             """,
+    )
+    parser.add_argument(
+        "--fetch-window",
+        dest="fetch_window",
+        metavar="PAGES",
+        type=int,
+        default=4,
+        help="""Number of fetched pages of events allowed to wait for processing.
+             Bounds memory use per room
+             """,
+    )
+    parser.add_argument(
+        "--export-format",
+        dest="export_format",
+        choices=["json", "ndjson"],
+        default="json",
+        help="""Format of exported messages: a new pretty-printed messages.json
+             array every run (json, default), or one compact event per line
+             appended to messages.jsonl (ndjson)
+             """,
+    )
+    parser.add_argument(
+        "--export-gzip",
+        dest="export_gzip",
+        action="store_true",
+        help="""Compress exported messages with gzip
+             """,
+    )
+    parser.add_argument(
+        "--source-compression",
+        dest="source_compression",
+        choices=["zlib", "zstd"],
+        help="""Compress event sources stored in data.db, using a dictionary
+             trained on the room's events. zstd needs the zstandard package
+             """,
+    )
+    parser.add_argument(
+        "--compact-db",
+        dest="compact_db",
+        action="store_true",
+        help="""Re-encode the event sources of every data.db in the output
+             folder with the current --source-compression and exit
+             """,
+    )
+    parser.add_argument(
+        "--migrate-db",
+        dest="migrate_db",
+        action="store_true",
+        help="""Upgrade every data.db in the output folder to the current
+             schema and exit. Databases are also upgraded when a room is archived
+             """,
+    )
+    parser.add_argument(
+        "--media-store",
+        dest="media_store",
+        action="store_true",
+        help="""Store the media of all rooms once, in a content-addressed
+             media-store folder in the output folder, instead of in a media
+             folder per room
+             """,
+    )
+    parser.add_argument(
+        "--migrate-media-store",
+        dest="migrate_media_store",
+        choices=["link", "move"],
+        help="""Hard-link or move the media of every room into the media
+             store, update the room databases and exit
+             """,
+    )
+    parser.add_argument(
+        "--search",
+        metavar="QUERY",
+        help="""Search archived messages in the output folder (FTS5 query syntax)
+             and exit
+             """,
+    )
+    parser.add_argument(
+        "--search-room",
+        dest="search_room",
+        metavar="ROOM_ID",
+        help="""Only search this room
+             """,
+    )
+    parser.add_argument(
+        "--search-page",
+        dest="search_page",
+        metavar="N",
+        type=int,
+        default=1,
+        help="""Page of search results to show
+             """,
+    )
+    parser.add_argument(
+        "--search-page-size",
+        dest="search_page_size",
+        metavar="N",
+        type=int,
+        default=20,
+        help="""Number of search results per page
+             """,
+    )
+    parser.add_argument(
+        "--metrics-report",
+        dest="metrics_report",
+        metavar="FILE",
+        help="""Write counters, histograms and the time spent in each stage
+             of the run (fetching, media, database...) to FILE as JSON when
+             it ends
+             """,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        metavar="PORT",
+        type=int,
+        help="""Serve the metrics in the Prometheus text format on
+             http://0.0.0.0:PORT/metrics while running
+             """,
+    )
+    parser.add_argument(
+        "--db-batch-size",
+        dest="db_batch_size",
+        metavar="N",
+        type=int,
+        default=1000,
+        help="""Number of events written to the database per transaction
+             """,
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        metavar="SECONDS",
+        type=int,
+        default=60,
+        help="""Commit processed events and the pagination checkpoint at least
+             this often, so an interrupted run resumes from there
+             """,
+    )
     parser.add_argument(
         "--no-progress-bar",
         dest="no_progress_bar",
@@ -156,6 +460,30 @@ def parse_args():
         help="""Don't log in log files
              """,
     )
+    parser.add_argument(
+        "--log-dir",
+        dest="log_dir",
+        default="/matrix_archive/logs",
+        help="""Folder of the log files (default: /matrix_archive/logs)
+             """,
+    )
+    parser.add_argument(
+        "--log-level",
+        dest="log_level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="""Only log messages of this level and above (default: INFO)
+             """,
+    )
+    parser.add_argument(
+        "--log-format",
+        dest="log_format",
+        choices=["text", "json"],
+        default="text",
+        help="""Log plain text (default) or one JSON object per line, on the
+             console and in the log file
+             """,
+    )
     parser.add_argument(
         "--no-avatars",
         dest="no_avatars",
@@ -166,6 +494,39 @@ def parse_args():
     return parser.parse_args()
 
 
+# login details of the last run when using --store-dir, so the device and its
+# crypto store can be reused.
+def load_credentials(homeserver, user_id):
+    try:
+        with open(f"{ARGS.store_dir}/credentials.json") as f:
+            credentials = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if credentials.get("homeserver") != homeserver or credentials.get("user_id") != user_id:
+        return None
+    return credentials
+
+
+def save_credentials(homeserver, client):
+    credentials = {
+        "homeserver": homeserver,
+        "user_id": client.user_id,
+        "device_id": client.device_id,
+        "access_token": client.access_token,
+    }
+    fd = os.open(f"{ARGS.store_dir}/credentials.json", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(credentials, f)
+
+
+# nio retries rate limited and timed out requests itself by default, which
+# the governor would then only see as latency. with retries turned off they
+# are returned or raised, and the governor backs off, so every request of
+# the client has to go through it, see governed.
+def client_config(store_class):
+    return AsyncClientConfig(store=store_class, max_limit_exceeded=0, max_timeouts=0)
+
+
 async def create_client() -> AsyncClient:
     homeserver = ARGS.server
     user_id = ARGS.user
@@ -174,22 +535,76 @@ async def create_client() -> AsyncClient:
         homeserver = input(
             f"Enter URL of your homeserver: [{homeserver}] ") or homeserver
         user_id = input(f"Enter your full user ID: [{user_id}] ") or user_id
-        password = getpass.getpass()
-    client = AsyncClient(
-        homeserver=homeserver,
-        user=user_id,
-        config=AsyncClientConfig(store=store.SqliteMemoryStore),
-    )
-    await client.login(password, DEVICE_NAME)
-    client.load_store()
+    if ARGS.store_dir is None:
+        if not ARGS.batch:
+            password = getpass.getpass()
+        client = AsyncClient(
+            homeserver=homeserver,
+            user=user_id,
+            config=client_config(store.SqliteMemoryStore),
+        )
+        await governed("Login", client.login, password, DEVICE_NAME)
+        client.load_store()
+    else:
+        client = await restore_client(homeserver, user_id, password)
     room_keys_path = ARGS.keys
     room_keys_password = ARGS.keyspass
     if not ARGS.batch:
         room_keys_path = input(
             f"Enter full path to room E2E keys: [{room_keys_path}] ") or room_keys_path
+    # A persistent store already holds the keys of an unchanged export.
+    keys_marker = f"{ARGS.store_dir}/imported-keys.txt"
+    keys_state = None
+    if ARGS.store_dir is not None:
+        keys_state = f"{client.device_id} {utils.file_hash(room_keys_path)}"
+        if os.path.exists(keys_marker):
+            with open(keys_marker) as f:
+                if f.read() == keys_state:
+                    log("Room keys unchanged since last import, skipping import.")
+                    return client
+    if not ARGS.batch:
         room_keys_password = getpass.getpass("Room keys password: ")
     log("Importing keys. This may take a while...")
     await client.import_keys(room_keys_path, room_keys_password)
+    if keys_state is not None:
+        with open(keys_marker, "w") as f:
+            f.write(keys_state)
+    return client
+
+
+# client with an on-disk crypto store in --store-dir, reusing the device and
+# access token of the last run when they are still valid.
+async def restore_client(homeserver, user_id, password) -> AsyncClient:
+    mkdir(ARGS.store_dir)
+    credentials = load_credentials(homeserver, user_id)
+    if credentials is not None:
+        client = AsyncClient(
+            homeserver=homeserver,
+            user=user_id,
+            device_id=credentials["device_id"],
+            store_path=ARGS.store_dir,
+            config=client_config(store.SqliteStore),
+        )
+        client.restore_login(user_id, credentials["device_id"], credentials["access_token"])
+        if isinstance(await governed("Checking the saved login", client.whoami), WhoamiResponse):
+            log(f"Reusing device {client.device_id}.")
+            return client
+        log("Saved login is no longer valid, logging in again.")
+        await client.close()
+    if not ARGS.batch:
+        password = getpass.getpass()
+    client = AsyncClient(
+        homeserver=homeserver,
+        user=user_id,
+        store_path=ARGS.store_dir,
+        config=client_config(store.SqliteStore),
+    )
+    response = await governed("Login", client.login, password, DEVICE_NAME)
+    if not isinstance(response, LoginResponse):
+        raise Exception(f"Login failed: {response}")
+    if client.olm is None:
+        client.load_store()
+    save_credentials(homeserver, client)
     return client
 
 
@@ -201,6 +616,97 @@ async def select_room(client: AsyncClient) -> MatrixRoom:
     return client.rooms[room_id]
 
 
+def get_room_dir(room_id):
+    room_short_id = str(room_id).split(':')[0].replace("!", "").replace("/", "_")
+    return f"{OUTPUT_DIR}/{room_short_id}"
+
+
+# data.db of every room archived in the output folder
+def list_room_databases():
+    for entry in sorted(os.listdir(OUTPUT_DIR)):
+        dbfile = f"{OUTPUT_DIR}/{entry}/data.db"
+        if os.path.isfile(dbfile):
+            yield entry, dbfile
+
+
+def compact_databases():
+    for room_short_id, dbfile in list_room_databases():
+        log(f"Compacting {dbfile}...")
+        size_before = os.path.getsize(dbfile)
+        db = DB(dbfile, room_short_id, ARGS.db_batch_size, ARGS.source_compression)
+        db.compact_sources(ARGS.db_batch_size)
+        db.conn.close()
+        log(f"{dbfile}: {size_before} -> {os.path.getsize(dbfile)} bytes")
+
+
+def migrate_databases():
+    # opening a DB upgrades its schema
+    for room_short_id, dbfile in list_room_databases():
+        log(f"Migrating {dbfile}...")
+        db = DB(dbfile, room_short_id, ARGS.db_batch_size, ARGS.source_compression)
+        db.conn.close()
+
+
+# move (or hard-link) the media/ files of every room into the media store
+# and point the room's events and uris at their names in there.
+def migrate_media_store():
+    store = MediaStore(f"{OUTPUT_DIR}/{MEDIA_STORE_DIR}")
+    link = ARGS.migrate_media_store == "link"
+    try:
+        for room_short_id, dbfile in list_room_databases():
+            media_dir = f"{OUTPUT_DIR}/{room_short_id}/media"
+            if not os.path.isdir(media_dir):
+                continue
+            log(f"Moving media of {room_short_id} into the media store...")
+            db = DB(dbfile, room_short_id, ARGS.db_batch_size, ARGS.source_compression)
+            names = {}
+            for name in os.listdir(media_dir):
+                path = f"{media_dir}/{name}"
+                if not os.path.isfile(path):
+                    continue
+                extension = name.split('.', 1)[1] if '.' in name else ''
+                names[name] = store.put(path, utils.file_hash(path), utils.file_size(path), extension, link)
+            db.rename_media(names)
+            for uri, cipher_hash, name in db.get_media_uris():
+                if store.exists(name):
+                    store.index.insert_media_uri(uri, cipher_hash, name)
+            db.conn.close()
+            log(f"{room_short_id}: {len(names)} media files {'linked' if link else 'moved'}.")
+    finally:
+        store.close()
+
+
+# full-text search over one room (--search-room) or all rooms in the output
+# folder. results of all rooms are merged by rank and paginated.
+def search_archive():
+    if ARGS.search_room:
+        dbfile = f"{get_room_dir(ARGS.search_room)}/data.db"
+        if not os.path.isfile(dbfile):
+            log(f"Room {ARGS.search_room} is not archived in {OUTPUT_DIR}.", file=sys.stderr)
+            return
+        databases = [(ARGS.search_room, dbfile)]
+    else:
+        databases = list(list_room_databases())
+    offset = (ARGS.search_page - 1) * ARGS.search_page_size
+    results = []
+    for room_short_id, dbfile in databases:
+        # every room contributes at most the results up to the requested page
+        found = search_database(dbfile, ARGS.search, offset + ARGS.search_page_size)
+        if found is None:
+            log(f"Room {room_short_id} has no search index yet, archive it again to search it.", file=sys.stderr)
+            continue
+        for result in found:
+            result['room'] = room_short_id
+            results.append(result)
+    results.sort(key=lambda result: result['rank'])
+    for result in results[offset:offset + ARGS.search_page_size]:
+        sender = result['sender']
+        if result['sender_name']:
+            sender = f"{result['sender_name']} <{sender}>"
+        log(f"{result['date']} [{result['room']}] {sender}: {result['snippet']} ({result['event_id']})")
+    log(f"Page {ARGS.search_page}, {min(len(results) - offset, ARGS.search_page_size) if len(results) > offset else 0} results.")
+
+
 def choose_filename(filename):
     start, ext = os.path.splitext(filename)
     for i in itertools.count(1):
@@ -229,48 +735,265 @@ def log_event(event : Event):
     if hasattr(event, "source"):
         log(f'Event Source: {json.dumps(event.source, indent=4)}')
 
-async def save_current_avatars(client: AsyncClient, room: MatrixRoom) -> None:
-    room_short_id = str(room.room_id).split(':')[0].replace("!", "").replace("/", "_")
-    roomdir = mkdir(f"{OUTPUT_DIR}/{room_short_id}")
+# snapshot the current avatar of every member into currentavatars/. the url
+# saved for each user is remembered, so only avatars that changed since the
+# last run are fetched, a few at a time. the snapshots are hard links into the
+# media dir where possible.
+async def save_current_avatars(client: AsyncClient, room: MatrixRoom, db: DB, temp_dir, media_dir) -> None:
+    roomdir = mkdir(get_room_dir(room.room_id))
     avatar_dir = mkdir(
         f"{roomdir}/currentavatars")
-    for user in room.users.values():
-        if user.avatar_url:
-            async with aiofiles.open(f"{avatar_dir}/{user.user_id.replace('/', '_')}", "wb") as f:
-                await f.write(await download_mxc(client, user.avatar_url))
+    saved = db.get_current_avatars()
+    avatars = {user.user_id: user.avatar_url for user in room.users.values() if user.avatar_url}
+    todo = [(user_id, url) for user_id, url in avatars.items()
+            if saved.get(user_id, (None,))[0] != url or not os.path.exists(avatar_filename(avatar_dir, user_id))]
+    removed = [user_id for user_id in saved if user_id not in avatars]
+    limit = asyncio.Semaphore(ARGS.media_concurrency)
+
+    async def save_avatar(user_id, url):
+        async with limit:
+            try:
+                media_name = await save_media(client, url, db, temp_dir, media_dir)
+            except DownloadError as err:
+                # not remembered, so it is tried again next run
+                metrics.MEDIA_REQUESTS.inc(result="failed")
+                log(err, file=sys.stderr, level=logging.WARNING)
+                return None
+        # names without extension of older versions, or a file that is gone
+        media_name = find_media(media_dir, media_name)
+        if media_name is None:
+            raise FileNotFoundError(f"Media file of avatar {url} of {user_id} is missing in {media_dir}")
+        link_media(f"{media_dir}/{media_name}", avatar_filename(avatar_dir, user_id))
+        return user_id, url, media_name
+
+    results = await asyncio.gather(*(save_avatar(user_id, url) for user_id, url in todo), return_exceptions=True)
+    for user_id in removed:
+        try:
+            os.remove(avatar_filename(avatar_dir, user_id))
+        except FileNotFoundError:
+            pass
+    # remember the avatars that were saved before giving up on a failed one
+    db.set_current_avatars(
+        [result for result in results if result is not None and not isinstance(result, BaseException)], removed)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    if todo or removed:
+        log(f"Updated {len(todo)} and removed {len(removed)} current avatars, {len(avatars) - len(todo)} unchanged.")
+
 
+def avatar_filename(avatar_dir, user_id):
+    return f"{avatar_dir}/{user_id.replace('/', '_')}"
 
-async def download_mxc(client: AsyncClient, url: str):
+
+# put a copy of source at target, sharing its bytes through a hard link when
+# both are on the same file system.
+def link_media(source, target):
+    # renaming a link onto the same file would do nothing
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    temp_target = f"{target}.tmp"
+    try:
+        if os.path.lexists(temp_target):
+            os.remove(temp_target)
+        os.link(source, temp_target)
+    except OSError:
+        shutil.copyfile(source, temp_target)
+    os.replace(temp_target, target)
+
+
+# download an mxc url straight into filename, decrypting it on the fly when
+# file_info (content.file of an encrypted event) is given.
+# returns sha256, size and guessed extension of the (decrypted) file.
+async def download_mxc(client: AsyncClient, url: str, filename: str, file_info=None):
     mxc = urlparse(url)
     http_method, path = Api.download(mxc.netloc, mxc.path.strip("/"))
     content_url = getattr(client, "homeserver", "https://" + mxc.hostname) + path
-    return download_url(content_url)
+    with metrics.stage("media_download"):
+        return await DOWNLOADER.download_to_file(content_url, filename, file_info)
+
+
+# content.file of an encrypted attachment, None for unencrypted media
+def event_file_info(event):
+    file_info = dict(event.source.get("content") or {}).get("file")
+    if isinstance(file_info, dict) and "key" in file_info:
+        return file_info
+    return None
+
+
+# download an mxc url into the de-duplicated media dir, returns the name of
+# the file in there. urls that were saved before are not downloaded again.
+async def save_media(client, url, db, temp_dir, media_dir, file_info=None, timestamp=None):
+    # events sharing a file wait for the first download, which they then
+    # find by its uri, instead of writing the same .part file
+    async with media_lock((temp_dir, url)):
+        return await save_media_unlocked(client, url, db, temp_dir, media_dir, file_info, timestamp)
 
 
+# downloads in progress by (temp dir, url): [lock, number of users]
+MEDIA_LOCKS = {}
+
+
+@contextlib.asynccontextmanager
+async def media_lock(key):
+    entry = MEDIA_LOCKS.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del MEDIA_LOCKS[key]
+
+
+async def save_media_unlocked(client, url, db, temp_dir, media_dir, file_info=None, timestamp=None):
+    cipher_hash = None
+    if file_info is not None:
+        # raises EncryptionError for a malformed file info before anything
+        # is downloaded
+        attachment_cipher(file_info)
+        cipher_hash = file_info["hashes"]["sha256"]
+    known_name = db.get_media_with_uri(url, cipher_hash)
+    if known_name is None and STORE is not None:
+        # saved by another room
+        known_name = STORE.index.get_media_with_uri(url, cipher_hash)
+        if STORE.exists(known_name):
+            db.insert_media_uri(url, cipher_hash, known_name)
+    if known_name is not None:
+        # older versions saved de-duplicated uris without the extension
+        name = find_media(media_dir, known_name)
+        if name is not None:
+            if name != known_name:
+                db.insert_media_uri(url, cipher_hash, name)
+            metrics.MEDIA_REQUESTS.inc(result="known")
+            return name
+    metrics.MEDIA_REQUESTS.inc(result="downloaded")
+
+    # download file first into a .part file named after the url, which a
+    # later attempt (or run) resumes.
+    filename = f"{temp_dir}/{part_filename(url)}"
+    hash_current, size_current, extension = await download_mxc(client, url, filename, file_info)
+    if timestamp is not None:
+        # Set atime and mtime of file to event timestamp
+        os.utime(filename, ns=(
+                (timestamp * 1000000,) * 2))
+
+    new_name = put_media(filename, media_dir, db, hash_current, size_current, extension, STORE)
+    db.insert_media_uri(url, cipher_hash, new_name)
+    if STORE is not None:
+        STORE.index.insert_media_uri(url, cipher_hash, new_name)
+    return new_name
+
+
+# the RoomEventFilter described by the filter options, None if none is set.
+def build_event_filter():
+    event_filter = {}
+    for key, values in (("types", ARGS.include_types), ("not_types", ARGS.exclude_types),
+                        ("senders", ARGS.include_senders), ("not_senders", ARGS.exclude_senders)):
+        if values:
+            event_filter[key] = values
+    if ARGS.lazy_load_members:
+        event_filter["lazy_load_members"] = True
+    return event_filter or None
+
+
+# one room_messages request. rate limits, server and connection errors raise
+# RetryableError, so the governor retries the page instead of the pagination
+# stopping early.
+async def request_room_messages(client, room, start_token, direction):
+    try:
+        with metrics.stage("fetch"), metrics.ROOM_MESSAGES_SECONDS.time():
+            response = await client.room_messages(
+                room.room_id, start_token, limit=ARGS.page_size, direction=direction,
+                message_filter=EVENT_FILTER
+            )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        raise RetryableError(str(err) or type(err).__name__)
+    if isinstance(response, RoomMessagesError):
+        check_retryable(response)
+    return response
+
+
+# raise RetryableError for an error response of nio that is worth sending
+# again: rate limited, a server error (whatever its errcode, e.g. a 5xx with
+# M_UNKNOWN) or no response at all.
+def check_retryable(response):
+    if not isinstance(response, ErrorResponse):
+        return
+    status = getattr(response.transport_response, "status", None)
+    if response.status_code in (None, "M_LIMIT_EXCEEDED") or response.retry_after_ms is not None \
+            or status == 429 or (status is not None and status >= 500):
+        retry_after = response.retry_after_ms / 1000 if response.retry_after_ms is not None else None
+        raise RetryableError(f"{response.message} (HTTP {status})" if status else response.message, retry_after)
+
+
+# a request of the client, e.g. governed("Login", client.login, password),
+# that is retried by the governor like a page of events.
+async def governed(description, call, *args, timed=True, **kwargs):
+    async def request():
+        try:
+            response = await call(*args, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise RetryableError(str(err) or type(err).__name__)
+        check_retryable(response)
+        return response
+    return await GOVERNOR.run(request, description, timed)
+
+
+async def governed_sync(client, **kwargs):
+    return await governed("Sync", client.sync, timed=False, **kwargs)
+
+
+# paginate from start_token until the server sends no end token, one page at
+# a time. every page comes with the token to resume from after it and whether
+# the end of the timeline in that direction was reached.
 async def fetch_room_events(
         client: AsyncClient,
         start_token: str,
         room: MatrixRoom,
         direction: MessageDirection,
-) -> list:
-    events = []
+):
+    fetched = 0
+    progress = Progress()
     while True:
-        response = await client.room_messages(
-            room.room_id, start_token, limit=100, direction=direction
-        )
+        response = await GOVERNOR.run(
+            lambda: request_room_messages(client, room, start_token, direction), "Fetching room messages")
         if isinstance(response, RoomMessagesError):
-	        break
-        if len(response.chunk) == 0:
+            log(f"Fetching room messages failed: {response.message}", file=sys.stderr)
+            break
+        fetched += len(response.chunk)
+        metrics.EVENTS_FETCHED.inc(len(response.chunk))
+        # an empty chunk doesn't mean there is nothing left, e.g. when the
+        # server filtered a whole page for history visibility; only a missing
+        # end does. older servers return the same token again instead.
+        complete = response.end is None or (len(response.chunk) == 0 and response.end == start_token)
+        if not complete:
+            start_token = response.end
+        yield response.chunk, start_token, complete
+        if complete:
             break
-        events.extend(
-            event for event in response.chunk)
-        start_token = response.end
         if not ARGS.no_progress_bar:
-            sys.stdout.write(
-                f"Fetched {str(len(events))} events for room {room.display_name}." + '\r')
-            sys.stdout.flush()
-    log('Fetch done!')
-    return events
+            progress.show(f"Fetched {str(fetched)} events for room {room.display_name}.")
+    progress.close()
+    log('Fetch done!', level=logging.DEBUG)
+
+
+# fetch pages of the given (checkpoint, direction, token) plan into a bounded
+# queue, so fetching runs ahead of processing by at most maxsize pages.
+async def produce_room_pages(client, room, plan, queue: asyncio.Queue):
+    try:
+        for checkpoint, direction, token in plan:
+            async for events, end_token, complete in fetch_room_events(client, token, room, direction):
+                if direction == MessageDirection.back:
+                    events = list(reversed(events))
+                await queue.put((checkpoint, events, end_token, complete))
+                metrics.FETCH_QUEUE_DEPTH.inc()
+    except Exception as err:
+        # hand the error over to the consumer, which re-raises it
+        await queue.put(err)
+        return
+    await queue.put(None)
 
 
 # return a dict of needed values to fill in database and write JSON.
@@ -292,6 +1015,8 @@ async def prepare_event_for_database(event, client, room, db, temp_dir, media_di
     event_parsed['sender'] = ""
     event_parsed['media_uuid'] = ""
     event_parsed['source'] = ""
+    event_parsed['ts'] = None
+    event_parsed['sender_name'] = None
 
     # set event_id for dict
     if hasattr(event, "event_id"):
@@ -307,12 +1032,16 @@ async def prepare_event_for_database(event, client, room, db, temp_dir, media_di
     # set message sender and source code for dict
     if hasattr(event, "sender"):
         event_parsed['sender'] = event.sender
+        if event.sender in room.users:
+            event_parsed['sender_name'] = room.users[event.sender].display_name
     if hasattr(event, "source"):
-        event_parsed['source'] = json.dumps(event.source, indent=4)
+        with metrics.stage("serialize"):
+            event_parsed['source'] = json.dumps(event.source, ensure_ascii=False, separators=(',', ':'))
 
     # set timestamp for dict
     if not dict(event.source).get("origin_server_ts") is None:
         timestamp = dict(event.source).get("origin_server_ts")
+        event_parsed['ts'] = timestamp
         date = datetime.datetime.fromtimestamp(timestamp / 1000)
         event_parsed['date'] = date.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
         event.source["_date"] = event_parsed['date']
@@ -324,108 +1053,40 @@ async def prepare_event_for_database(event, client, room, db, temp_dir, media_di
     # this try block is for all downloading media stuff.
     if not ARGS.no_media:
         try:
+            url = None
             # download media if necessary, and de-duplicate media files, organize them in database.
             # currently for RoomMessageMedia, RoomEncryptedMedia, StickerEvent
             if isinstance(event, (RoomMessageMedia, RoomEncryptedMedia, StickerEvent)):
-
-                # download file first with a random filename.
-                media_data = await download_mxc(client, event.url)
-                filename = choose_filename(
-                    f"{temp_dir}/{str(generate_uuid1())}")
-                async with aiofiles.open(filename, "wb") as f_media:
-                    try:
-                        await f_media.write(
-                            crypto.attachments.decrypt_attachment(
-                                media_data,
-                                event.source["content"]["file"]["key"]["k"],
-                                event.source["content"]["file"]["hashes"]["sha256"],
-                                event.source["content"]["file"]["iv"],
-                            )
-                        )
-                    except KeyError:  # EAFP: Unencrypted media produces KeyError
-                        await f_media.write(media_data)
-                # Set atime and mtime of file to event timestamp
-                os.utime(filename, ns=(
-                        (event.server_timestamp * 1000000,) * 2))
-
-                # oraganize file in database, get new filename.
-                new_name = put_media(filename, media_dir, db)
-                event.source["_file_path"] = new_name
-                event_parsed['media_uuid'] = new_name
+                url = event.url
 
             # download avatars for user who changes avatar, and de-duplicate media files, organize them in database.
             # currently for RoomMemberEvent
             # only proceed without --no-avatars flag
             if isinstance(event, (RoomMemberEvent)) and (not ARGS.no_avatars):
-
                 # look for avatar_url
-                avatar_url = dict(event.content).get('avatar_url')
-                if not (avatar_url is None):
-
-                    # download file first with a random filename.
-                    media_data = await download_mxc(client, avatar_url)
-                    filename = choose_filename(
-                        f"{temp_dir}/{str(generate_uuid1())}")
-                    event.source["_file_path"] = filename
-                    async with aiofiles.open(filename, "wb") as f_media:
-                        try:
-                            await f_media.write(
-                                crypto.attachments.decrypt_attachment(
-                                    media_data,
-                                    event.source["content"]["file"]["key"]["k"],
-                                    event.source["content"]["file"]["hashes"]["sha256"],
-                                    event.source["content"]["file"]["iv"],
-                                )
-                            )
-                        except KeyError:  # EAFP: Unencrypted media produces KeyError
-                            await f_media.write(media_data)
-                        # Set atime and mtime of file to event timestamp
-                        os.utime(filename, ns=(
-                                (event.server_timestamp * 1000000,) * 2))
-
-                    # oraganize file in database, get new filename.
-                    new_name = put_media(
-                        filename, media_dir, db)
-                    event.source["_file_path"] = new_name
-                    event_parsed['media_uuid'] = new_name
+                url = dict(event.content).get('avatar_url')
 
             # download avatars for rooms changing avatar, and de-duplicate media files, organize them in database.
             # currently for RoomAvatarEvent
             if isinstance(event, (RoomAvatarEvent)):
-
                 # look for content
                 content = dict(event.source).get('content')
                 if not content is None:
                     # look for _url
                     url = dict(content).get('url')
-                    if not (url is None):
-
-                        # download file first with a random filename.
-                        media_data = await download_mxc(client, url)
-                        filename = choose_filename(
-                            f"{temp_dir}/{str(generate_uuid1())}")
-                        event.source["_file_path"] = filename
-                        async with aiofiles.open(filename, "wb") as f_media:
-                            try:
-                                await f_media.write(
-                                    crypto.attachments.decrypt_attachment(
-                                        media_data,
-                                        event.source["content"]["file"]["key"]["k"],
-                                        event.source["content"]["file"]["hashes"]["sha256"],
-                                        event.source["content"]["file"]["iv"],
-                                    )
-                                )
-                            except KeyError:  # EAFP: Unencrypted media produces KeyError
-                                await f_media.write(media_data)
-                            # Set atime and mtime of file to event timestamp
-                            os.utime(filename, ns=(
-                                    (event.server_timestamp * 1000000,) * 2))
-
-                        # oraganize file in database, get new filename.
-                        new_name = put_media(
-                            filename, media_dir, db)
-                        event.source["_file_path"] = new_name
-                        event_parsed['media_uuid'] = new_name
+
+            if not (url is None):
+                # oraganize file in database, get new filename.
+                new_name = await save_media(client, url, db, temp_dir, media_dir,
+                                            event_file_info(event), event.server_timestamp)
+                event.source["_file_path"] = new_name
+                event_parsed['media_uuid'] = new_name
+        except (DownloadError, exceptions.EncryptionError) as err:
+            # e.g. deleted on the server, or an attachment that doesn't match
+            # its hash or key: that won't change, so the event is kept
+            # without its media instead of being fetched again every run
+            metrics.MEDIA_REQUESTS.inc(result="failed")
+            log(err, file=sys.stderr, level=logging.WARNING)
         except TypeError as tperror:
             log(f'Again... TypeError: {tperror}')
             log_event(event)
@@ -433,92 +1094,407 @@ async def prepare_event_for_database(event, client, room, db, temp_dir, media_di
     return event_parsed
 
 
-async def write_room_events(client, room):
-    log(
-        f"Fetching {room.room_id} room messages (aka {room.display_name}) and writing to disk...")
-    sync_resp = await client.sync(
-        full_state=True, sync_filter={"room": {"timeline": {"limit": 1}}}
+# the file processed events are exported to: a new messages(N).json array
+# every run, or one messages.jsonl per room that every run appends to. what
+# a killed run exported after its last commit is dropped, those events are
+# fetched again.
+def open_exporter(roomdir, db, export_format):
+    # (file name, position) of the export at the last commit, see
+    # RoomArchive.sync_export
+    position = db.get_checkpoint("export_position")
+    name, end = json.loads(position) if position else (None, None)
+    if export_format == "ndjson":
+        filename = f"{roomdir}/messages.jsonl"
+        if ARGS.export_gzip:
+            filename += ".gz"
+        committed = end if name == os.path.basename(filename) else None
+        if not ARGS.export_gzip:
+            truncate_partial_line(filename, committed)
+        return NdjsonWriter(open_text(filename, "a", ARGS.export_gzip, committed), filename)
+    # the arrays of killed runs get what they spooled until their last commit
+    for spool in sorted(glob.glob(f"{glob.escape(roomdir)}/*.spool")):
+        unfinished = spool[:-len(".spool")]
+        committed = end if name == os.path.basename(unfinished) else 0
+        if committed:
+            log(f"Finishing {unfinished}, which an interrupted run left unfinished.")
+            finish_json_export(unfinished, unfinished.endswith(".gz"), committed)
+        else:
+            os.remove(spool)
+    # get filename for message.json this time:
+    filename = choose_filename(f"{roomdir}/messages.json.gz" if ARGS.export_gzip else f"{roomdir}/messages.json")
+    return JsonArrayWriter(filename, ARGS.export_gzip)
+
+
+# same as prepare_event_for_database, but returns None for events that fail
+# to decrypt instead of raising.
+async def prepare_event(event, client, room, db, temp_dir, media_dir):
+    try:
+        with metrics.stage("prepare"):
+            return await prepare_event_for_database(event, client, room, db, temp_dir, media_dir)
+    except exceptions.EncryptionError as e:
+        log(e, file=sys.stderr)
+        return None
+
+
+async def get_start_token(client, room):
+    sync_resp = await governed_sync(
+        client, full_state=True, sync_filter={"room": {"timeline": {"limit": 1}}}
     )
-    start_token = sync_resp.rooms.join[room.room_id].timeline.prev_batch
+    return sync_resp.rooms.join[room.room_id].timeline.prev_batch
 
-    # Generally, it should only be necessary to fetch back events but,
-    # sometimes depending on the sync, front events need to be fetched
-    # as well.
-    fetch_room_events_ = partial(fetch_room_events, client, start_token, room)
-    room_short_id = str(room.room_id).split(':')[0].replace("!", "").replace("/", "_")
-    roomdir = mkdir(f"{OUTPUT_DIR}/{room_short_id}")
 
-    # prepare database
-    dbfile = f"{roomdir}/data.db"
-    db = DB(dbfile, room.display_name)
-    if not ARGS.no_media:
-        temp_dir = mkdir(
-            f"{roomdir}/temp")
-        media_dir = mkdir(
-            f"{roomdir}/media")
+# database, media directories and export file of a room, kept open while
+# events of the room are written.
+class RoomArchive():
 
-    # get filename for message.json this time:
-    messages_json_filename = choose_filename(f"{roomdir}/messages.json")
-
-    async with aiofiles.open(
-            messages_json_filename, "w"
-    ) as f_json:
-        list_all_events = list(reversed(await fetch_room_events_(MessageDirection.back))) + list(
-            await fetch_room_events_(MessageDirection.front))
-        process_bar = ShowProcess(len(list_all_events), "Export Accomplished!")
-        events_parsed = []
-        for event in list_all_events:
-            if db.event_exists(event) == "insert":
-                try:
-                    event_parsed = await prepare_event_for_database(event, client, room, db, temp_dir, media_dir)
-                    events_parsed.append(event.source)
-                    # insert event into database
-                    db.insert_event(event_parsed['event_id'], event_parsed['category'], event_parsed['date'],
-                                    event_parsed['body'], event_parsed['sender'], event_parsed['media_uuid'],
-                                    event_parsed['source'])
-                    if not ARGS.no_progress_bar:
-                        process_bar.show_process()
-                except exceptions.EncryptionError as e:
-                    log(e, file=sys.stderr)
-            elif db.event_exists(event) == "update":
-                try:
-                    event_parsed = await prepare_event_for_database(event, client, room, db, temp_dir, media_dir)
-                    events_parsed.append(event.source)
-                    # update event in database
-                    db.update_event(event_parsed['event_id'], event_parsed['category'], event_parsed['date'],
-                                    event_parsed['body'], event_parsed['sender'], event_parsed['media_uuid'],
-                                    event_parsed['source'])
-                    if not ARGS.no_progress_bar:
-                        process_bar.show_process()
-                except exceptions.EncryptionError as e:
-                    log(e, file=sys.stderr)
+    def __init__(self, room, export_format=None):
+        self.room = room
+        self.roomdir = mkdir(get_room_dir(room.room_id))
+        # prepare database
+        self.db = DB(f"{self.roomdir}/data.db", room.display_name, ARGS.db_batch_size,
+                     ARGS.source_compression, room.room_id, ARGS.checkpoint_interval)
+        self.temp_dir = self.media_dir = None
+        if not ARGS.no_media:
+            self.temp_dir = mkdir(
+                f"{self.roomdir}/temp")
+            if STORE is not None:
+                self.media_dir = STORE.path
+                reconcile_media(self.temp_dir, None, self.db)
+            else:
+                self.media_dir = mkdir(
+                    f"{self.roomdir}/media")
+                reconcile_media(self.temp_dir, self.media_dir, self.db)
+        self.exporter = open_exporter(self.roomdir, self.db, export_format or ARGS.export_format)
+        self.db.before_commit = self.sync_export
+        self.written = 0
+
+    # runs before every commit of events: the export is made durable, and
+    # how far it got is committed with the events, so after a kill the next
+    # run continues the export right where the committed events end.
+    def sync_export(self):
+        self.db.set_checkpoint("export_position",
+                               json.dumps([os.path.basename(self.exporter.filename), self.exporter.sync()]))
+
+    # temp/ is kept while it holds .part files of interrupted downloads, the
+    # next run resumes them.
+    def remove_temp_dir(self):
+        if self.temp_dir is not None and not os.listdir(self.temp_dir):
+            os.rmdir(self.temp_dir)
+
+    # write the events that aren't archived yet (or are BadEvents there).
+    # media of all events is downloaded concurrently, rows are still written
+    # in timeline order.
+    async def write_events(self, client, events):
+        db = self.db
+        todo = [(event, action) for event, action in zip(events, db.classify_events(events))
+                if action in ("insert", "update")]
+        metrics.EVENTS_WRITTEN.inc(len(events) - len(todo), action="known")
+        results = await asyncio.gather(*(
+            prepare_event(event, client, self.room, db, self.temp_dir, self.media_dir) for event, _ in todo))
+        for (event, action), event_parsed in zip(todo, results):
+            if event_parsed is None:
+                metrics.EVENTS_WRITTEN.inc(action="failed")
+                continue
+            metrics.EVENTS_WRITTEN.inc(action=action)
+            self.written += 1
+            with metrics.stage("export"):
+                self.exporter.write(event.source)
+            args = (event_parsed['event_id'], event_parsed['category'], event_parsed['date'],
+                    event_parsed['body'], event_parsed['sender'], event_parsed['media_uuid'],
+                    event_parsed['source'], event_parsed['ts'], event_parsed['sender_name'])
+            if action == "insert":
+                db.insert_event(*args)
             else:
+                db.update_event(*args)
+
+    # fetch and write the pages of the given (checkpoint, direction, token)
+    # plan, with fetching running ahead by at most --fetch-window pages.
+    # done_message is logged at the end, unless it is None.
+    async def write_pages(self, client, plan, done_message="Export Accomplished!"):
+        db = self.db
+        queue = asyncio.Queue(maxsize=ARGS.fetch_window)
+        producer = asyncio.ensure_future(produce_room_pages(client, self.room, plan, queue))
+        try:
+            process_bar = ShowProcess(None, done_message)
+            while True:
+                page = await queue.get()
+                if isinstance(page, tuple):
+                    metrics.FETCH_QUEUE_DEPTH.dec()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                checkpoint, events, end_token, complete = page
+                self.exporter.start_page(backwards=checkpoint == "oldest")
+                await self.write_events(client, events)
                 if not ARGS.no_progress_bar:
-                    process_bar.show_process()
-        if ARGS.no_progress_bar:
-            log("Export Accomplished!")
-        db.flush_events()
-        # serialise message array and write to message.json
-        await f_json.write(json.dumps(events_parsed, indent=4))
+                    process_bar.show_process(process_bar.i + len(events))
+                # The page is fully handled: how far we got is persisted
+                # together with its events on the next flush.
+                db.set_checkpoint(f"{checkpoint}_token", end_token)
+                if events:
+                    db.set_checkpoint(f"{checkpoint}_event_id", events[-1 if checkpoint == "newest" else 0].event_id)
+                if checkpoint == "oldest" and complete:
+                    db.set_checkpoint("backfill_done", "1")
+                db.flush_if_due()
+            db.flush_events()
+            process_bar.close()
+        finally:
+            producer.cancel()
+
+    def close(self):
+        self.db.flush_events()
+        self.db.before_commit = None
+        # close the message array in message.json
+        self.exporter.close()
+
+
+# start_token is the prev_batch of a recent sync, fetched when not given.
+# returns the number of events written.
+async def write_room_events(client, room, start_token=None):
+    log(
+        f"Fetching {room.room_id} room messages (aka {room.display_name}) and writing to disk...")
+    archive = RoomArchive(room)
+    db = archive.db
+    try:
+        # Resume from the checkpoint of the last run: only events newer than
+        # newest_token are fetched, plus older history if the backfill never
+        # reached the beginning of the room.
+        newest_token = db.get_checkpoint("newest_token")
+        oldest_token = db.get_checkpoint("oldest_token")
+        backfill_done = db.get_checkpoint("backfill_done") == "1"
+        if (ARGS.full_scan or newest_token is None or (not backfill_done and oldest_token is None)) \
+                and start_token is None:
+            start_token = await get_start_token(client, room)
+        if ARGS.full_scan or newest_token is None:
+            newest_token = oldest_token = start_token
+            backfill_done = False
+            if ARGS.full_scan:
+                # an interrupted full scan is finished by the next run
+                db.set_checkpoint("backfill_done", "0")
+                db.set_checkpoint("oldest_token", oldest_token)
+                db.flush_events()
+        elif not backfill_done and oldest_token is None:
+            oldest_token = start_token
+
+        # New events first, then whatever is left of the backfill.
+        plan = [("newest", MessageDirection.front, newest_token)]
+        if not backfill_done:
+            plan.append(("oldest", MessageDirection.back, oldest_token))
+        await archive.write_pages(client, plan)
+    finally:
+        archive.close()
     if (not ARGS.no_avatars) and (not ARGS.no_media):
-        await save_current_avatars(client, room)
-    os.rmdir(temp_dir)
+        await save_current_avatars(client, room, db, archive.temp_dir, archive.media_dir)
+    archive.remove_temp_dir()
     log("Successfully wrote all room events to disk.")
+    return archive.written
+
+
+# parse a stored source again, decrypting it with the keys known now.
+# returns None if it still can't be decrypted.
+def redecrypt_source(client, room, source):
+    event_dict = json.loads(source)
+    for key in ("_sender_name", "_date", "_file_path"):
+        event_dict.pop(key, None)
+    event = Event.parse_event(event_dict)
+    if isinstance(event, MegolmEvent):
+        event.room_id = room.room_id
+        try:
+            event = client.decrypt_event(event)
+        except exceptions.EncryptionError:
+            return None
+    return event
+
+
+# retry only the stored BadEvent/Unknown/undecrypted rows of a room from
+# their SOURCE, without paginating the room. rows that decrypt now are
+# updated, their media is downloaded like for new events.
+async def redecrypt_room_events(client, room):
+    log(f"Retrying undecrypted events of {room.room_id} (aka {room.display_name})...")
+    archive = RoomArchive(room)
+    retried = 0
+    try:
+        last_rowid = 0
+        while True:
+            rows = archive.db.get_bad_events(last_rowid, REDECRYPT_BATCH_SIZE)
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            retried += len(rows)
+            events = []
+            for rowid, event_id, source in rows:
+                try:
+                    event = redecrypt_source(client, room, source)
+                except ValueError as err:
+                    log(f"Can't parse stored event {event_id}: {err}", file=sys.stderr)
+                    continue
+                if event is not None:
+                    events.append(event)
+            # rows that parse now are classified as "update"
+            await archive.write_events(client, events)
+            archive.db.flush_if_due()
+    finally:
+        archive.close()
+    archive.remove_temp_dir()
+    log(f"Room {room.display_name}: {archive.written} of {retried} bad events could be decrypted now.")
+
+
+# after the initial archive, keep long-polling sync and write new timeline
+# events of the rooms as they arrive.
+async def follow_rooms(client, rooms, since):
+    log(f"Following {len(rooms)} rooms for new events...")
+    archives = {}
+    # a json array is only written out when it is closed, which a followed
+    # room never is until the process stops, so new events go to messages.jsonl
+    if ARGS.export_format != "ndjson":
+        log("New events are exported as ndjson (messages.jsonl) while following.")
+    try:
+        for room in rooms:
+            archives[room.room_id] = RoomArchive(room, "ndjson")
+        timeline_filter = {key: value for key, value in (EVENT_FILTER or {}).items() if key != "lazy_load_members"}
+        sync_filter = {"room": {"rooms": list(archives),
+                                "timeline": {**timeline_filter, "limit": FOLLOW_TIMELINE_LIMIT}}}
+        if ARGS.lazy_load_members:
+            # a state filter option in sync, unlike in room_messages
+            sync_filter["room"]["state"] = {"lazy_load_members": True}
+        while True:
+            try:
+                response = await governed_sync(client, timeout=FOLLOW_SYNC_TIMEOUT, since=since, sync_filter=sync_filter)
+            except NetworkException as err:
+                # keep following after the governor gave up
+                response = SyncError(err.message)
+            if isinstance(response, SyncError):
+                log(f"Sync failed: {response.message}", file=sys.stderr)
+                await asyncio.sleep(FOLLOW_RETRY_DELAY)
+                continue
+            for room_id, room_info in response.rooms.join.items():
+                archive = archives.get(room_id)
+                if archive is None or not room_info.timeline.events:
+                    continue
+                if room_info.timeline.limited:
+                    # there is a gap before these events, page through
+                    # everything since the last checkpoint instead
+                    newest_token = archive.db.get_checkpoint("newest_token")
+                    await archive.write_pages(client, [("newest", MessageDirection.front, newest_token)], None)
+                else:
+                    await archive.write_events(client, room_info.timeline.events)
+                    # sync tokens are valid pagination tokens too
+                    archive.db.set_checkpoint("newest_token", response.next_batch)
+                    archive.db.set_checkpoint("newest_event_id", room_info.timeline.events[-1].event_id)
+                    archive.db.flush_events()
+            since = response.next_batch
+    finally:
+        for archive in archives.values():
+            archive.close()
+        log("Export Accomplished!")
+
+
+# rooms with the most pending work go first: rooms that were never archived,
+# then unfinished backfills, then by unread notifications (new events).
+def room_priority(room, sync_room):
+    checkpoints = read_checkpoints(f"{get_room_dir(room.room_id)}/data.db")
+    if checkpoints.get("newest_token") is None:
+        backlog = 2
+    elif checkpoints.get("backfill_done") != "1":
+        backlog = 1
+    else:
+        backlog = 0
+    unread = 0
+    notifications = getattr(sync_room, "unread_notifications", None)
+    if notifications is not None:
+        unread = notifications.notification_count or 0
+    return backlog, unread
+
+
+# archive rooms with up to --room-concurrency of them at the same time, all
+# sharing the client and its connection pool.
+async def archive_rooms(client, rooms, sync_resp):
+    joined = sync_resp.rooms.join
+    pending = sorted(rooms, key=lambda room: room_priority(room, joined.get(room.room_id)), reverse=True)
+
+    async def worker():
+        while pending:
+            room = pending.pop(0)
+            start_token = None
+            if room.room_id in joined:
+                start_token = joined[room.room_id].timeline.prev_batch
+            started = time.monotonic()
+            written = await write_room_events(client, room, start_token)
+            elapsed = time.monotonic() - started
+            log(f"Room {room.display_name}: wrote {written} events in {elapsed:.1f}s "
+                f"({written / max(elapsed, 0.001):.1f} events/s).",
+                room_id=room.room_id, events=written, seconds=round(elapsed, 3))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(ARGS.room_concurrency, len(rooms)))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+# counters, histograms and per-stage timings of the run, see metrics.py
+def write_metrics_report():
+    with open(ARGS.metrics_report, 'w') as f:
+        json.dump(metrics.METRICS.report(), f, indent=4)
 
 
 async def main() -> None:
+    global DOWNLOADER, GOVERNOR, STORE, EVENT_FILTER
+    EVENT_FILTER = build_event_filter()
+    GOVERNOR = RequestGovernor(ARGS.max_requests)
+    DOWNLOADER = Downloader(ARGS.media_concurrency, governor=GOVERNOR,
+                            workers=MediaWorkers(ARGS.media_workers, ARGS.media_pool))
+    client = None
+    metrics_server = None
+    # Let docker stop / SIGTERM unwind like an exception, so the finally
+    # blocks commit what was processed instead of losing it.
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
     try:
-        client = await create_client()
-        await client.sync(
-            full_state=True,
-            # Limit fetch of room events as they will be fetched later
-            sync_filter={"room": {"timeline": {"limit": 1}}})
+        # these work on the output folder only, no login needed
+        if ARGS.migrate_db:
+            migrate_databases()
+            raise SystemExit
+        if ARGS.migrate_media_store is not None:
+            migrate_media_store()
+            raise SystemExit
+        if ARGS.compact_db:
+            compact_databases()
+            raise SystemExit
+        if ARGS.search is not None:
+            search_archive()
+            raise SystemExit
+        if ARGS.metrics_port is not None:
+            metrics_server = await metrics.start_server(ARGS.metrics_port)
+        if ARGS.media_store:
+            STORE = MediaStore(f"{OUTPUT_DIR}/{MEDIA_STORE_DIR}")
+        with metrics.stage("login"):
+            client = await create_client()
+        with metrics.stage("sync"):
+            sync_resp = await governed_sync(
+                client,
+                full_state=True,
+                # Limit fetch of room events as they will be fetched later
+                sync_filter={"room": {"timeline": {"limit": 1}}})
+        selected_rooms = []
         for room_id, room in client.rooms.items():
             # Iterate over rooms to see if a room has been selected to
             # be automatically fetched
             if room_id in ARGS.room or any(re.match(pattern, room_id) for pattern in ARGS.roomregex):
                 log(f"Selected room: {room_id}")
-                await write_room_events(client, room)
+                selected_rooms.append(room)
+        if ARGS.redecrypt:
+            for room in selected_rooms:
+                await redecrypt_room_events(client, room)
+            raise SystemExit
+        with metrics.stage("archive"):
+            await archive_rooms(client, selected_rooms, sync_resp)
+        if ARGS.follow:
+            await follow_rooms(client, selected_rooms, sync_resp.next_batch)
         if ARGS.batch:
             # If the program is running in unattended batch mode,
             # then we can quit at this point
@@ -528,22 +1504,35 @@ async def main() -> None:
                 room = await select_room(client)
                 await write_room_events(client, room)
     except KeyboardInterrupt as ki:
-        log(ki, file=sys.stderr)
+        log(ki, file=sys.stderr, level=logging.ERROR)
+        sys.exit(1)
+    except asyncio.CancelledError:
+        log("Stopped. Events processed so far have been saved, the next run resumes from there.", file=sys.stderr, level=logging.ERROR)
         sys.exit(1)
     except NetworkException as ne:
-        log(ne.message + ', Details:', file=sys.stderr)
-        log(ne.details, file=sys.stderr)
+        log(ne.message + ', Details:', file=sys.stderr, level=logging.ERROR)
+        log(ne.details, file=sys.stderr, level=logging.ERROR)
         sys.exit(4)
     except DatabaseException as de:
-        log(de.message + ', Details:', file=sys.stderr)
-        log(de.details, file=sys.stderr)
+        log(de.message + ', Details:', file=sys.stderr, level=logging.ERROR)
+        log(de.details, file=sys.stderr, level=logging.ERROR)
         sys.exit(3)
     except Exception as err:
-        log(err, file=sys.stderr)
+        log(err, file=sys.stderr, level=logging.ERROR)
         sys.exit(1)
     finally:
-        await client.logout()
-        await client.close()
+        if client is not None:
+            # a persistent device stays logged in for the next run
+            if ARGS.store_dir is None:
+                await governed("Logout", client.logout)
+            await client.close()
+        await DOWNLOADER.close()
+        if STORE is not None:
+            STORE.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        if ARGS.metrics_report is not None:
+            write_metrics_report()
 
 
 if __name__ == "__main__":
@@ -552,6 +1541,5 @@ if __name__ == "__main__":
         # Select all rooms by adding a regex pattern which matches every string
         ARGS.roomregex.append(".*")
     OUTPUT_DIR = mkdir(ARGS.folder)
-    utils.NO_LOG = ARGS.no_logs
-    utils.LOG_NAME = ''
+    setup_logging(None if ARGS.no_logs else ARGS.log_dir, ARGS.log_level, ARGS.log_format)
     asyncio.run(main())
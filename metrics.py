@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+import contextlib
+import threading
+import time
+
+# upper bounds of histogram buckets
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROWS_BUCKETS = (1, 10, 100, 500, 1000, 5000, 10000)
+
+# metrics are updated from media worker threads as well
+LOCK = threading.Lock()
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values -> value
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{value}"' for label, value in pairs) + "}"
+
+    # plain value for metrics without labels, "label=value,..." -> value
+    # otherwise
+    def report(self):
+        values = {key: self.report_value(value) for key, value in self.values.items()}
+        if not self.labels:
+            return values.get((), self.report_value(self.empty()))
+        return {",".join(f"{label}={value}" for label, value in zip(self.labels, key)): value
+                for key, value in values.items()}
+
+    def empty(self):
+        return 0
+
+    def report_value(self, value):
+        return value
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = self.values or ({(): self.empty()} if not self.labels else {})
+        for key, value in values.items():
+            lines.extend(self.prometheus_lines(key, value))
+        return lines
+
+    def prometheus_lines(self, key, value):
+        return [f"{self.name}{self.label_text(key)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with LOCK:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with LOCK:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with LOCK:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def empty(self):
+        # count per bucket (not cumulative, the last one is +Inf), sum, max
+        return [[0] * (len(self.buckets) + 1), 0, 0]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with LOCK:
+            counts, total, maximum = self.values.get(key) or self.empty()
+            index = 0
+            while index < len(self.buckets) and value > self.buckets[index]:
+                index += 1
+            counts[index] += 1
+            self.values[key] = [counts, total + value, max(maximum, value)]
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def report_value(self, value):
+        counts, total, maximum = value
+        count = sum(counts)
+        return {"count": count, "sum": round(total, 6), "avg": round(total / count, 6) if count else 0,
+                "max": round(maximum, 6)}
+
+    def prometheus_lines(self, key, value):
+        counts, total, maximum = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self.label_text(key, [('le', bound)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self.label_text(key)} {total}")
+        lines.append(f"{self.name}_count{self.label_text(key)} {cumulative}")
+        return lines
+
+
+class Registry():
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def report(self):
+        report = {"wall_seconds": round(time.monotonic() - self.started, 3)}
+        # busy time per stage, summed over concurrent tasks, so a stage can
+        # take longer than the run
+        report["stages"] = {key.split("=", 1)[1]: {"seconds": value["sum"], "count": value["count"]}
+                            for key, value in STAGE_SECONDS.report().items()}
+        for kind in ("counter", "gauge", "histogram"):
+            report[f"{kind}s"] = {metric.name: metric.report() for metric in self.metrics if metric.kind == kind}
+        return report
+
+    def prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.prometheus())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+
+STAGE_SECONDS = METRICS.add(Histogram(
+    "matrix_archive_stage_seconds", "Time spent in each stage of archiving", ["stage"]))
+ROOM_MESSAGES_SECONDS = METRICS.add(Histogram(
+    "matrix_archive_room_messages_seconds", "Latency of room_messages requests"))
+EVENTS_FETCHED = METRICS.add(Counter(
+    "matrix_archive_events_fetched_total", "Events returned by room_messages"))
+EVENTS_WRITTEN = METRICS.add(Counter(
+    "matrix_archive_events_total", "Fetched events by what was done with them", ["action"]))
+FETCH_QUEUE_DEPTH = METRICS.add(Gauge(
+    "matrix_archive_fetch_queue_pages", "Fetched pages waiting to be processed, over all rooms"))
+MEDIA_REQUESTS = METRICS.add(Counter(
+    "matrix_archive_media_total", "Media of events and avatars by how they were resolved", ["result"]))
+MEDIA_BYTES = METRICS.add(Counter(
+    "matrix_archive_media_downloaded_bytes_total", "Bytes of media downloaded (decrypted)"))
+MEDIA_DEDUP_HITS = METRICS.add(Counter(
+    "matrix_archive_media_dedup_hits_total", "Downloaded media that was already stored with the same hash"))
+HTTP_RETRIES = METRICS.add(Counter(
+    "matrix_archive_request_retries_total", "Homeserver requests that failed temporarily and were retried"))
+HTTP_IN_FLIGHT = METRICS.add(Gauge(
+    "matrix_archive_requests_in_flight", "Homeserver requests currently running"))
+HTTP_LIMIT = METRICS.add(Gauge(
+    "matrix_archive_request_limit", "Current adaptive limit of concurrent homeserver requests"))
+DB_FLUSH_ROWS = METRICS.add(Histogram(
+    "matrix_archive_db_flush_rows", "Event rows written per database batch commit", buckets=ROWS_BUCKETS))
+
+
+def stage(name):
+    return STAGE_SECONDS.time(stage=name)
+
+
+# serve METRICS in the Prometheus text format on http://host:port/metrics
+# while the run is in progress. returns the runner to clean up.
+async def start_server(port, host="0.0.0.0"):
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=METRICS.prometheus().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.add_routes([web.get("/metrics", handle)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Current avatar snapshots of members whose avatars have the same content
+# under different mxc uris, e.g. puppets of a bridge. Run with
+#   python -m unittest discover tests
+
+import argparse
+import asyncio
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, PACKAGE_DIR)
+
+import utils
+from db import DB
+
+spec = importlib.util.spec_from_file_location("matrix_archive", os.path.join(PACKAGE_DIR, "matrix-archive.py"))
+matrix_archive = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(matrix_archive)
+
+AVATAR = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+
+class CurrentAvatarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.media_dir = utils.mkdir(f"{self.dir}/media")
+        self.temp_dir = utils.mkdir(f"{self.dir}/temp")
+        self.db = DB(f"{self.dir}/data.db", "room", room_id="!room:example.org")
+        matrix_archive.OUTPUT_DIR = self.dir
+        matrix_archive.ARGS = argparse.Namespace(media_concurrency=2)
+        self.downloads = []
+
+        # stands in for the homeserver: every uri has the same content
+        async def save_media(client, url, db, temp_dir, media_dir):
+            self.downloads.append(url)
+            filename = f"{temp_dir}/{utils.part_filename(url)}"
+            with open(filename, "wb") as f:
+                f.write(AVATAR)
+            name = utils.put_media(filename, media_dir, db)
+            db.insert_media_uri(url, None, name)
+            return name
+        matrix_archive.save_media = save_media
+
+    def tearDown(self):
+        self.db.conn.close()
+        shutil.rmtree(self.dir)
+
+    def room(self, avatars):
+        users = {user_id: types.SimpleNamespace(user_id=user_id, avatar_url=url) for user_id, url in avatars.items()}
+        return types.SimpleNamespace(room_id="!room:example.org", users=users)
+
+    def save(self, room):
+        asyncio.run(matrix_archive.save_current_avatars(None, room, self.db, self.temp_dir, self.media_dir))
+
+    def test_store_media_returns_filename_on_dedup(self):
+        names = []
+        for i in range(2):
+            filename = f"{self.temp_dir}/{i}"
+            with open(filename, "wb") as f:
+                f.write(AVATAR)
+            names.append(utils.put_media(filename, self.media_dir, self.db))
+        self.assertEqual(names[0], names[1])
+        self.assertTrue(names[0].endswith(".png"))
+        self.assertEqual(os.listdir(self.media_dir), [names[0]])
+
+    def test_shared_avatar_hash(self):
+        room = self.room({"@a:example.org": "mxc://example.org/a", "@b:example.org": "mxc://example.org/b"})
+        self.save(room)
+        avatar_dir = f"{self.dir}/room/currentavatars"
+        self.assertEqual(sorted(os.listdir(avatar_dir)), ["@a:example.org", "@b:example.org"])
+        for name in os.listdir(avatar_dir):
+            with open(f"{avatar_dir}/{name}", "rb") as f:
+                self.assertEqual(f.read(), AVATAR)
+        [stored] = os.listdir(self.media_dir)
+        self.assertEqual({url for url, _ in self.db.get_current_avatars().values()},
+                         {"mxc://example.org/a", "mxc://example.org/b"})
+        self.assertEqual({name for _, name in self.db.get_current_avatars().values()}, {stored})
+
+        # nothing changed, nothing is fetched
+        self.downloads.clear()
+        self.save(room)
+        self.assertEqual(self.downloads, [])
+
+        # one member changed their avatar, another one removed it
+        self.save(self.room({"@a:example.org": "mxc://example.org/c"}))
+        self.assertEqual(self.downloads, ["mxc://example.org/c"])
+        self.assertEqual(os.listdir(avatar_dir), ["@a:example.org"])
+        self.assertEqual(list(self.db.get_current_avatars()), ["@a:example.org"])
+
+    def test_rename_media_updates_current_avatars(self):
+        self.save(self.room({"@a:example.org": "mxc://example.org/a"}))
+        [stored] = os.listdir(self.media_dir)
+        self.db.rename_media({stored: "ab/cd/abcd.png"})
+        self.assertEqual(self.db.get_current_avatars(),
+                         {"@a:example.org": ("mxc://example.org/a", "ab/cd/abcd.png")})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,19 +1,45 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
+import asyncio
+import atexit
+import base64
 import datetime
+import glob
+import gzip
 import hashlib
+import json
+import logging
+import logging.handlers
 import os
+import queue
+import random
 import shutil
 import sys
+import tempfile
 import time
 import uuid
-from db import DB
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from db import DB, MediaIndex
+import metrics
 
+import aiohttp
 import filetype
-import requests
+from Crypto.Cipher import AES
+from nio.exceptions import EncryptionError
 
-global LOG_NAME
-global NO_LOG
+CHUNK_SIZE = 65536
+# downloaded data handed to a media worker at once
+WORK_SIZE = 1048576
+# bytes filetype looks at to guess a file type
+HEAD_SIZE = 8192
+# partial downloads older than this many seconds are given up
+PART_MAX_AGE = 7 * 24 * 3600
+# seconds between progress updates on a terminal, and as log lines otherwise
+PROGRESS_INTERVAL = 0.5
+PROGRESS_INTERVAL_PIPE = 10
+
+LOGGER = logging.getLogger("matrix-archive")
 
 
 def mkdir(path):
@@ -24,45 +50,259 @@ def mkdir(path):
     return path
 
 
-def log(message: object, file=sys.stdout):
-    global LOG_NAME
-    global NO_LOG
-    if LOG_NAME == '':
-        LOG_NAME = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-    print(message, file=file)
-    if not NO_LOG:
-        log_dir = mkdir('/matrix_archive/logs')
-        log_file = f'{log_dir}/{LOG_NAME}.txt'
+# messages to stderr are warnings unless a level is given. fields are added
+# to JSON log lines.
+def log(message: object, file=sys.stdout, level=None, **fields):
+    if level is None:
+        level = logging.WARNING if file is sys.stderr else logging.INFO
+    if not LOGGER.handlers:
+        # logging wasn't set up, e.g. when used as a module
+        print(message, file=file)
+        return
+    LOGGER.log(level, message, extra={"fields": fields})
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname.lower(),
+            "message": record.getMessage(),
+        }
+        line.update(getattr(record, "fields", {}))
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+# messages go to stdout (warnings and errors to stderr) and, unless log_dir
+# is None, to one log file per run. the file is written by a background
+# thread, so logging never waits for the disk.
+def setup_logging(log_dir=None, level="INFO", log_format="text"):
+    if log_format == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(message)s")
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.addFilter(lambda record: record.levelno < logging.WARNING)
+    stderr = logging.StreamHandler(sys.stderr)
+    stderr.setLevel(logging.WARNING)
+    for handler in (stdout, stderr):
+        handler.setFormatter(formatter)
+        LOGGER.addHandler(handler)
+    LOGGER.setLevel(level)
+    LOGGER.propagate = False
+    if log_dir is not None:
+        name = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")
         try:
-            writer = open(log_file, mode='a+', encoding='utf-8')
-        except:
-            print('Log file error.', file=sys.stderr)
+            file_handler = logging.FileHandler(f"{mkdir(log_dir)}/{name}.txt", encoding='utf-8')
+        except OSError as err:
+            print(f'Log file error. {err}', file=sys.stderr)
             sys.exit(1)
-        writer.write(datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S") + '\n' + str(message) + '\n')
-        writer.close()
+        if log_format != "json":
+            formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s", "%Y-%m-%d %H-%M-%S")
+        file_handler.setFormatter(formatter)
+        records = queue.Queue()
+        LOGGER.addHandler(logging.handlers.QueueHandler(records))
+        listener = logging.handlers.QueueListener(records, file_handler)
+        listener.start()
+        # the listener writes what is queued before the process exits
+        atexit.register(listener.stop)
+
+
+# shows at most one update per PROGRESS_INTERVAL on a terminal. when the
+# output is piped (e.g. docker logs), an update is a log line and comes only
+# every PROGRESS_INTERVAL_PIPE.
+class Progress():
+
+    def __init__(self):
+        self.tty = sys.stdout.isatty()
+        self.interval = PROGRESS_INTERVAL if self.tty else PROGRESS_INTERVAL_PIPE
+        self.last = None
+        self.shown = False
+
+    def show(self, text, force=False):
+        now = time.monotonic()
+        if not force and self.last is not None and now - self.last < self.interval:
+            return
+        if self.last is None and not force:
+            # the first update waits an interval too, short runs print none
+            self.last = now
+            return
+        self.last = now
+        if self.tty:
+            sys.stdout.write(text + '\r')
+            sys.stdout.flush()
+            self.shown = True
+        else:
+            log(text)
+
+    # ends the line of the last update on a terminal
+    def close(self):
+        if self.shown:
+            print('')
+            self.shown = False
+
+
+# returns MEDIA_UUID.extension, or the name in store (a MediaStore) if given.
+# hash, size and extension ('' for an unknown type) can be passed in when
+# they were computed while downloading.
+def put_media(file, media_dir, db, hash_current=None, size_current=None, extension=None, store=None):
+    with metrics.stage("media_store"):
+        if store is not None:
+            if hash_current is None:
+                hash_current = file_hash(file)
+            if size_current is None:
+                size_current = file_size(file)
+            if extension is None:
+                extension = guess_extension(file)
+            return store.put(file, hash_current, size_current, extension)
+        return store_media(file, media_dir, db, hash_current, size_current, extension)
 
 
-# returns MEDIA_UUID.extension
-def put_media(file, media_dir, db):
+def store_media(file, media_dir, db, hash_current, size_current, extension):
     assert isinstance(db, DB)
-    hash_current = file_hash(file)
+    if hash_current is None:
+        hash_current = file_hash(file)
     existing_media = db.get_media_with_hash(hash_current)
-    size_current = file_size(file)
+    if size_current is None:
+        size_current = file_size(file)
+    if extension is None:
+        extension = guess_extension(file)
     for media in existing_media:
-        if media['size'] == size_current:
+        if media['size'] != size_current:
+            continue
+        # MEDIA only has the uuid, the file has its extension as well
+        name = find_media(media_dir, media['uuid'], extension)
+        if name is not None:
+            metrics.MEDIA_DEDUP_HITS.inc()
             os.unlink(file)
-            return media['uuid']
+            return name
     uuid = generate_uuid1()
     db.insert_media(uuid, hash_current, size_current)
-    kind = filetype.guess(file)
-    if not (kind is None):
-        shutil.move(file, f"{media_dir}/{uuid}.{kind.extension}")
-        return f"{uuid}.{kind.extension}"
+    if extension:
+        shutil.move(file, f"{media_dir}/{uuid}.{extension}")
+        return f"{uuid}.{extension}"
     else:
         shutil.move(file, f"{media_dir}/{uuid}")
         return f"{uuid}"
 
 
+# name of the file in media_dir stored as name, which may lack the extension
+# (uuids in MEDIA, and uris saved by older versions), None if there is none.
+def find_media(media_dir, name, extension=None):
+    candidates = [f"{name}.{extension}"] if extension else []
+    candidates.append(name)
+    for candidate in candidates:
+        if os.path.isfile(f"{media_dir}/{candidate}"):
+            return candidate
+    if '.' in os.path.basename(name):
+        return None
+    for found in sorted(glob.glob(f"{glob.escape(media_dir)}/{glob.escape(name)}.*")):
+        if not found.endswith(".tmp"):
+            return f"{name}{found[len(media_dir) + 1 + len(name):]}"
+    return None
+
+
+# clean up after a run that was killed: downloads left in temp_dir are
+# removed, except for recent .part files, which are resumed. files that made it into media_dir without their (uncommitted)
+# MEDIA row are registered, so later downloads of the same content are
+# de-duplicated against them instead of being stored twice. without
+# media_dir (files are in a MediaStore) only temp_dir is cleaned up.
+def reconcile_media(temp_dir, media_dir, db):
+    for name in os.listdir(temp_dir):
+        path = f"{temp_dir}/{name}"
+        if ".part" in name and time.time() - os.path.getmtime(path) < PART_MAX_AGE:
+            continue
+        os.unlink(path)
+    if media_dir is None:
+        return
+    known = db.get_media_uuids()
+    for name in os.listdir(media_dir):
+        uuid = name.split('.')[0]
+        if uuid not in known:
+            path = f"{media_dir}/{name}"
+            log(f"Registering media file left by an interrupted run: {name}")
+            db.insert_media(uuid, file_hash(path), file_size(path))
+    db.flush_events()
+
+
+# media of all rooms in one place (--media-store): a file is named by the
+# sha256 of its content, in two levels of subdirectories so none of them
+# gets too big (ab/cd/abcd...ef.png), and stored once however many rooms
+# posted it. index.db maps hashes and mxc uris to these names, rooms refer to
+# files by the name.
+class MediaStore():
+
+    def __init__(self, path):
+        self.path = mkdir(path)
+        self.index = MediaIndex(f"{path}/index.db")
+
+    def name_for(self, hash, extension):
+        name = f"{hash[:2]}/{hash[2:4]}/{hash}"
+        return f"{name}.{extension}" if extension else name
+
+    def exists(self, name):
+        return name is not None and os.path.exists(f"{self.path}/{name}")
+
+    # name of a stored file with this content, None if there is none. rows
+    # whose file is gone (e.g. killed before the move) don't count.
+    def lookup(self, hash, size):
+        for media in self.index.get_media_with_hash(hash):
+            if media['size'] == size and self.exists(media['uuid']):
+                return media['uuid']
+        return None
+
+    # move file into the store, or hard-link it (copy it across file
+    # systems) if link is set. returns its name in the store.
+    def put(self, file, hash, size, extension, link=False):
+        name = self.lookup(hash, size)
+        if name is not None:
+            metrics.MEDIA_DEDUP_HITS.inc()
+            if not link:
+                os.unlink(file)
+            return name
+        name = self.name_for(hash, extension)
+        target = f"{self.path}/{name}"
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if not link:
+            shutil.move(file, target)
+        elif not os.path.exists(target):
+            try:
+                os.link(file, target)
+            except OSError:
+                shutil.copy2(file, target)
+        # after the file is in place: a row never points to a missing file
+        self.index.insert_media(name, hash, size)
+        return name
+
+    def close(self):
+        self.index.close()
+
+
+# drop the unfinished last line a killed run may have left in a text file,
+# or, if end is given, the lines it wrote after its last commit.
+def truncate_partial_line(filename, end=None):
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb+') as f:
+        if end is not None:
+            if f.seek(0, os.SEEK_END) > end:
+                f.truncate(end)
+            return
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            step = min(CHUNK_SIZE, position)
+            f.seek(position - step)
+            index = f.read(step).rfind(b'\n')
+            if index != -1:
+                position = position - step + index + 1
+                break
+            position -= step
+        if position != end:
+            f.truncate(position)
+
+
 def file_hash(file):
     BLOCKSIZE = 65536
     sha = hashlib.sha256()
@@ -74,6 +314,17 @@ def file_hash(file):
     return sha.hexdigest()
 
 
+# extension of a file (its name or its first bytes), '' if the type is unknown
+def guess_extension(file):
+    kind = filetype.guess(file)
+    return kind.extension if kind is not None else ''
+
+
+# the .part file an mxc url is downloaded to, the same in every run
+def part_filename(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:32] + ".part"
+
+
 def file_size(file):
     return os.path.getsize(file)
 
@@ -82,25 +333,389 @@ def generate_uuid1():
     return str(uuid.uuid1()).replace("-", "")
 
 
-def download_url(url):
-    retries = 9
-    while retries >= 0:
-        try:
-            request = requests.get(url, timeout=10, stream=True)
-            # with open(file, 'wb') as fh:
-            #   for chunk in request.iter_content(8192):
-            #      fh.write(chunk)
-            return request.content
-        except Exception as err:
-            log(f"Download failed. {err}", file=sys.stderr)
-            if (retries > 0):
-                log("Retrying...")
-                retries = retries - 1
+# base64 as used by Matrix: unpadded, either standard or urlsafe alphabet
+def decode_base64(value):
+    value = value.replace('-', '+').replace('_', '/')
+    return base64.b64decode(value + '=' * (-len(value) % 4))
+
+
+# AES-CTR cipher and expected sha256 of the ciphertext of an encrypted
+# attachment. a file info with a missing or malformed key, iv or hash raises
+# EncryptionError, like decrypt_attachment of nio does for a bad key.
+def attachment_cipher(file_info):
+    try:
+        cipher = AES.new(decode_base64(file_info["key"]["k"]), AES.MODE_CTR,
+                         nonce=b'', initial_value=decode_base64(file_info["iv"]))
+        cipher_hash = decode_base64(file_info["hashes"]["sha256"])
+    except (KeyError, TypeError, AttributeError, ValueError) as err:
+        raise EncryptionError(f"Invalid file info of encrypted media: {err!r}")
+    if not cipher_hash:
+        raise EncryptionError("Invalid file info of encrypted media: empty sha256 hash")
+    return cipher, cipher_hash
+
+
+# writes a downloaded file chunk by chunk. for encrypted attachments
+# (file_info is content.file of the event) the ciphertext is checked against
+# its SHA-256 and decrypted with AES-CTR on the fly; SHA-256 and size of the
+# written file are computed on the way, so it never has to be read back.
+class MediaSink():
+
+    def __init__(self, filename, file_info=None, resume=False):
+        self.filename = filename
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.cipher = None
+        if file_info is not None:
+            self.cipher, self.cipher_hash_expected = attachment_cipher(file_info)
+            self.cipher_sha = hashlib.sha256()
+        self.f = open(filename, 'ab' if resume else 'wb')
+
+    def write(self, chunk):
+        with metrics.stage("media_process"):
+            self.process(chunk)
+
+    def process(self, chunk):
+        if self.cipher is not None:
+            self.cipher_sha.update(chunk)
+            chunk = self.cipher.decrypt(chunk)
+        self.count(chunk)
+        self.f.write(chunk)
+
+    def count(self, chunk):
+        self.sha.update(chunk)
+        if len(self.head) < HEAD_SIZE:
+            self.head += chunk[:HEAD_SIZE - len(self.head)]
+        self.size += len(chunk)
+
+    # resuming a download: what an earlier attempt wrote is hashed again and
+    # the cipher is advanced past it. CTR "decryption" of the plaintext
+    # gives back the ciphertext.
+    def replay(self):
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(WORK_SIZE), b''):
+                if self.cipher is not None:
+                    self.cipher_sha.update(self.cipher.decrypt(chunk))
+                self.count(chunk)
+
+    def close(self):
+        self.f.close()
+
+    def finish(self):
+        if self.cipher is not None and self.cipher_sha.digest() != self.cipher_hash_expected:
+            os.unlink(self.filename)
+            raise EncryptionError("Mismatched SHA-256 digest.")
+        return self.sha.hexdigest(), self.size, guess_extension(self.head)
+
+
+# decrypt (when file_info is given), hash and guess the type of a file that
+# was downloaded as is, in place. runs in worker processes, see MediaWorkers.
+def process_media_file(filename, file_info=None):
+    if file_info is None:
+        with open(filename, 'rb') as f:
+            head = f.read(HEAD_SIZE)
+        return file_hash(filename), file_size(filename), guess_extension(head)
+    sink = MediaSink(f"{filename}.dec", file_info)
+    try:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(WORK_SIZE), b''):
+                sink.write(chunk)
+    finally:
+        sink.close()
+    try:
+        result = sink.finish()
+    except EncryptionError:
+        os.unlink(filename)
+        raise
+    os.replace(f"{filename}.dec", filename)
+    return result
+
+
+# CPU-heavy media work (decryption, sha256, file type guessing) runs in a
+# pool of threads or processes instead of on the event loop, so fetching and
+# database writes go on while large files are processed. at most two jobs per
+# worker are queued; downloads wait for a free slot and stop reading from the
+# network meanwhile. without workers everything runs inline.
+class MediaWorkers():
+
+    def __init__(self, workers=0, kind="thread"):
+        self.kind = kind
+        self.pool = None
+        self.slots = None
+        if workers > 0:
+            if kind == "process":
+                self.pool = ProcessPoolExecutor(workers)
+            else:
+                self.pool = ThreadPoolExecutor(workers, thread_name_prefix="media")
+            self.slots = asyncio.Semaphore(workers * 2)
+
+    async def run(self, function, *args):
+        if self.pool is None:
+            return function(*args)
+        async with self.slots:
+            return await asyncio.get_event_loop().run_in_executor(self.pool, function, *args)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+# a request that failed temporarily (rate limited, server or connection
+# error) and may be sent again, after retry_after seconds if the server said so.
+class RetryableError(Exception):
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# the server refused a download (404, 403, ...), sending it again won't help.
+class DownloadError(Exception):
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+# all requests to the homeserver go through here. a request raising
+# RetryableError is sent again after the delay the server asked for, or after
+# an exponential backoff with jitter; a rate limit pauses all requests for
+# that long. how many requests run at once adapts between 1 and
+# max_concurrency: one more after a window of successes, half as many on
+# errors or when requests get much slower than the fastest one seen.
+class RequestGovernor():
+    # requests this many times slower than the fastest one (and slower than
+    # a second) mean the server is overloaded
+    SLOW_FACTOR = 8
+    # the limit is halved at most once per this many seconds, so one burst of
+    # failures doesn't collapse it to 1
+    DECREASE_INTERVAL = 2
+
+    def __init__(self, max_concurrency=16, retries=9, base_delay=0.5, max_delay=60):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        metrics.HTTP_LIMIT.set(self.limit)
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.successes = 0
+        self.best_latency = None
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.waiters = []
+
+    async def acquire(self):
+        while True:
+            wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
                 continue
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                metrics.HTTP_IN_FLIGHT.set(self.in_flight)
+                return
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    # ok is None for requests that ended without telling anything about the
+    # server, e.g. cancelled ones.
+    def release(self, ok=None, latency=None, retry_after=None):
+        self.in_flight -= 1
+        metrics.HTTP_IN_FLIGHT.set(self.in_flight)
+        now = time.monotonic()
+        if ok is False:
+            self.decrease(now)
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+        elif ok:
+            if latency is not None and self.best_latency is not None \
+                    and latency > max(1, self.SLOW_FACTOR * self.best_latency):
+                self.decrease(now)
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            if latency is not None and (self.best_latency is None or latency < self.best_latency):
+                self.best_latency = latency
+        metrics.HTTP_LIMIT.set(self.limit)
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+    def decrease(self, now):
+        self.successes = 0
+        if now - self.last_decrease >= self.DECREASE_INTERVAL:
+            self.limit = max(1, self.limit // 2)
+            self.last_decrease = now
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    # await request() until it doesn't raise RetryableError. timed requests
+    # also adapt the limit to their latency, which doesn't work for downloads
+    # of any size.
+    async def run(self, request, description="Request", timed=True):
+        for attempt in range(self.retries + 1):
+            await self.acquire()
+            start = time.monotonic()
+            try:
+                result = await request()
+            except RetryableError as err:
+                self.release(False, retry_after=err.retry_after)
+                error = err
+            except BaseException:
+                self.release()
+                raise
             else:
-                log("No more retries")
-                retries = retries - 1
-                raise NetworkException("Download failed. Please reload this script.", err)
+                self.release(True, time.monotonic() - start if timed else None)
+                return result
+            if attempt == self.retries:
+                break
+            metrics.HTTP_RETRIES.inc()
+            delay = error.retry_after if error.retry_after is not None else self.backoff(attempt)
+            log(f"{description} failed: {error}. Retrying in {delay:.1f}s...", file=sys.stderr)
+            await asyncio.sleep(delay)
+        raise NetworkException(f"{description} failed after {self.retries} retries. Please reload this script.", error)
+
+
+# seconds to wait before retrying a rate limited (429) or failed (5xx)
+# response: its Retry-After header or retry_after_ms of a Matrix error.
+async def response_retry_after(response):
+    header = response.headers.get("Retry-After")
+    if header is not None and header.isdigit():
+        return int(header)
+    try:
+        body = await response.json(content_type=None)
+        return body["retry_after_ms"] / 1000
+    except Exception:
+        return None
+
+
+# where the body of a response to a request for the rest of a file from
+# offset goes: offset if the server resumed there (206), or, for a 416, if
+# the file is already complete. 0 if the server sent the whole file, None
+# if it can't resume, e.g. a 206 for another range.
+def resume_position(response, offset):
+    content_range = parse_content_range(response.headers.get("Content-Range", ""))
+    if response.status == 206:
+        return offset if content_range is not None and content_range[0] == offset else None
+    if response.status == 416:
+        return offset if offset and content_range == (None, None, offset) else None
+    return 0
+
+
+# (first byte, last byte, total size) of a Content-Range header, the bytes
+# are None for "bytes */size" and the size for ".../*". None if it isn't one.
+def parse_content_range(value):
+    unit, _, rest = value.strip().partition(" ")
+    if unit != "bytes":
+        return None
+    byte_range, _, total = rest.partition("/")
+    try:
+        total = None if total == "*" else int(total)
+        if byte_range == "*":
+            return None, None, total
+        first, last = byte_range.split("-")
+        return int(first), int(last), total
+    except ValueError:
+        return None
+
+
+# downloads over one shared keep-alive connection pool, with at most
+# `concurrency` connections per host, so many files can be fetched in
+# parallel without blocking the event loop.
+class Downloader():
+
+    def __init__(self, concurrency=8, timeout=10, governor=None, workers=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.governor = governor or RequestGovernor(concurrency)
+        self.session = None
+        self.workers = workers or MediaWorkers()
+
+    def get_session(self):
+        # created lazily, aiohttp wants a running event loop
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.concurrency)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout))
+        return self.session
+
+    # streams url into filename chunk by chunk, see MediaSink.
+    # returns sha256, size and guessed extension of the written file.
+    async def download_to_file(self, url, filename, file_info=None):
+        result = await self.governor.run(
+            lambda: self.try_download_to_file(url, filename, file_info), "Download", timed=False)
+        metrics.MEDIA_BYTES.inc(result[1])
+        return result
+
+    # filename is kept when the download fails, and the next attempt only
+    # requests the rest of the file.
+    async def try_download_to_file(self, url, filename, file_info=None):
+        process = self.workers.kind == "process"
+        # a worker process gets the file as downloaded and decrypts it in the
+        # end, otherwise it is decrypted while downloading
+        part = f"{filename}.raw" if process else filename
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+        try:
+            async with self.get_session().get(url, headers=headers) as response:
+                if response.status == 429 or response.status >= 500:
+                    raise RetryableError(f"HTTP {response.status}", await response_retry_after(response))
+                # anything else but the file (or its rest) is an error page,
+                # which must not be stored as the media
+                if not (200 <= response.status < 300 or response.status == 416):
+                    raise DownloadError(f"Download of {url} failed: HTTP {response.status} {response.reason}",
+                                        response.status)
+                position = resume_position(response, offset)
+                if position is None:
+                    if os.path.exists(part):
+                        os.unlink(part)
+                    raise RetryableError("Can't resume download, starting over")
+                # nothing left to download
+                complete = response.status == 416
+                if process:
+                    with open(part, 'ab' if position else 'wb') as f:
+                        if not complete:
+                            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                                f.write(chunk)
+                    result = await self.workers.run(process_media_file, part, file_info)
+                    os.replace(part, filename)
+                    return result
+                sink = MediaSink(filename, file_info, resume=bool(position))
+                try:
+                    if position:
+                        await self.workers.run(sink.replay)
+                    buffer = bytearray()
+                    if not complete:
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            buffer += chunk
+                            if len(buffer) >= WORK_SIZE:
+                                await self.workers.run(sink.write, bytes(buffer))
+                                buffer.clear()
+                    if buffer:
+                        await self.workers.run(sink.write, bytes(buffer))
+                finally:
+                    sink.close()
+                return sink.finish()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise RetryableError(str(err) or type(err).__name__)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.workers.close()
 
 
 class ShowProcess():
@@ -113,29 +728,210 @@ class ShowProcess():
         self.max_steps = max_steps
         self.i = 0
         self.infoDone = infoDone
+        self.progress = Progress()
 
     def show_process(self, i=None):
         if i is not None:
             self.i = i
         else:
             self.i += 1
+        if not self.max_steps:
+            # total is unknown, e.g. while events are still being fetched
+            self.progress.show(str(self.i) + ' processed')
+            return
         num_arrow = int(self.i * self.max_arrow / self.max_steps)
         num_line = self.max_arrow - num_arrow
         percent = self.i * 100.0 / self.max_steps
         process_bar = '[' + '>' * num_arrow + '-' * num_line + ']' \
                       + '%.2f' % percent + '% - ' + \
-                      str(self.i) + ' of ' + str(self.max_steps) + '\r'
-        sys.stdout.write(process_bar)
-        sys.stdout.flush()
+                      str(self.i) + ' of ' + str(self.max_steps)
+        self.progress.show(process_bar, force=self.i >= self.max_steps)
         if self.i >= self.max_steps:
             self.close()
 
     def close(self):
-        print('')
-        log(self.infoDone)
+        self.progress.close()
+        if self.infoDone:
+            log(self.infoDone)
         self.i = 0
 
 
+# end is where the last committed run stopped appending, see GzipAppender
+def open_text(filename, mode, compress=False, end=None):
+    if compress and mode == 'a':
+        return GzipAppender(filename, end)
+    if compress:
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+# appending to a gzip file adds a new member, which readers handle. but a
+# run that is killed leaves its member unfinished, and once more members
+# follow, the file can't be read past it. so the size of the file before
+# the member is kept in filename.offset until the member is closed, and the
+# next run replaces an unfinished member with the lines that can still be
+# read from it, up to end if given.
+class GzipAppender():
+
+    def __init__(self, filename, end=None):
+        self.marker = f"{filename}.offset"
+        if os.path.exists(self.marker):
+            with open(self.marker) as f:
+                repair_gzip_member(filename, int(f.read() or 0), end)
+        with open(self.marker, 'w') as f:
+            f.write(str(os.path.getsize(filename) if os.path.exists(filename) else 0))
+        self.f = gzip.open(filename, 'at', encoding='utf-8')
+
+    def write(self, text):
+        self.f.write(text)
+
+    # compresses what is buffered with a sync flush, so everything written
+    # so far can be read back from the file even without the end of the member
+    def flush(self):
+        self.f.flush()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+        os.remove(self.marker)
+
+
+# cut what was written to a gzip file after offset, and append again the
+# complete lines that can be decompressed from it, up to end, as a new member.
+def repair_gzip_member(filename, offset, end=None):
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb+') as f, tempfile.TemporaryFile(dir=os.path.dirname(filename) or '.') as salvaged:
+        f.seek(offset)
+        remaining = None if end is None else max(0, end - offset)
+
+        def read():
+            nonlocal remaining
+            if remaining is None:
+                return f.read(CHUNK_SIZE)
+            data = f.read(min(CHUNK_SIZE, remaining))
+            remaining -= len(data)
+            return data
+
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        # bytes salvaged up to the end of the last complete line
+        size = complete = 0
+        chunk = read()
+        try:
+            while chunk:
+                data = decompressor.decompress(chunk)
+                if decompressor.eof:
+                    # the member was finished after all, maybe more follow
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                else:
+                    chunk = read()
+                salvaged.write(data)
+                newline = data.rfind(b'\n')
+                if newline != -1:
+                    complete = size + newline + 1
+                size += len(data)
+        except zlib.error:
+            pass
+        f.truncate(offset)
+        f.seek(offset)
+        if complete:
+            salvaged.seek(0)
+            with gzip.open(f, 'ab') as member:
+                while complete:
+                    data = salvaged.read(min(CHUNK_SIZE, complete))
+                    member.write(data)
+                    complete -= len(data)
+    log(f"Repaired {filename}, which an interrupted run left unfinished.", file=sys.stderr, level=logging.WARNING)
+
+
+# writes a JSON array formatted like json.dumps(list, indent=4), oldest
+# events first, without holding the whole list in memory. pages fetched
+# backwards arrive newest first, so elements go to filename.spool, a line
+# per element and a "<" (backwards) or ">" (forwards) line where a page
+# starts, until close writes the backwards pages in reverse, then the pages
+# fetched forwards. the spool of a killed run is finished by the next one,
+# see finish_json_export.
+class JsonArrayWriter():
+
+    def __init__(self, filename, compress=False):
+        self.filename = filename
+        self.compress = compress
+        self.spool = open(f"{filename}.spool", 'wb')
+
+    def start_page(self, backwards=False):
+        self.spool.write(b"<\n" if backwards else b">\n")
+
+    def write(self, obj):
+        self.spool.write(json.dumps(obj).encode() + b"\n")
+
+    # make what was written so far durable, returns how far that is
+    def sync(self):
+        self.spool.flush()
+        os.fsync(self.spool.fileno())
+        return self.spool.tell()
+
+    def close(self):
+        self.spool.close()
+        finish_json_export(self.filename, self.compress)
+
+
+# write the JSON array of filename from its spool and remove the spool. end
+# cuts off what a killed run spooled after its last commit.
+def finish_json_export(filename, compress, end=None):
+    spool_name = f"{filename}.spool"
+    with open(spool_name, 'rb+') as spool:
+        if end is not None:
+            spool.truncate(end)
+        # (backwards, start, end) of every page
+        pages = []
+        position = 0
+        for line in spool:
+            if line in (b"<\n", b">\n"):
+                pages.append([line == b"<\n", position + len(line), position + len(line)])
+            elif pages:
+                pages[-1][2] = position + len(line)
+            position += len(line)
+        f = open_text(filename, 'w', compress)
+        count = 0
+        for _, start, stop in [page for page in reversed(pages) if page[0]] + [page for page in pages if not page[0]]:
+            spool.seek(start)
+            for line in spool.read(stop - start).splitlines():
+                # json.dumps([obj], indent=4) is "[\n" + indented element + "\n]"
+                element = json.dumps([json.loads(line)], indent=4)[2:-2]
+                f.write(("[\n" if count == 0 else ",\n") + element)
+                count += 1
+        f.write("[]" if count == 0 else "\n]")
+        f.close()
+    os.remove(spool_name)
+
+
+# writes JSON Lines: one compact JSON document per line.
+class NdjsonWriter():
+
+    def __init__(self, f, filename):
+        self.f = f
+        self.filename = filename
+
+    # lines are appended as they are processed, see JsonArrayWriter
+    def start_page(self, backwards=False):
+        pass
+
+    def write(self, obj):
+        self.f.write(json.dumps(obj, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    # make the lines written so far durable, returns the size of the file
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return os.fstat(self.f.fileno()).st_size
+
+    def close(self):
+        self.f.close()
+
+
 class DatabaseException(Exception):
 
     def __init__(self, message, details):